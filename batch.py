@@ -0,0 +1,119 @@
+from typing import List, Dict
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from retrieval import Retriever, get_query_embeddings
+from pipeline import answer_question, get_answer_cache
+from config import *
+
+
+def read_questions(path: str) -> List[Dict[str, any]]:
+    # One JSON object per line: {"question": ..., "id": optional, "filters": optional}
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: invalid JSON ({e})")
+            if isinstance(item, str):
+                item = {"question": item}
+            if not isinstance(item, dict) or not (item.get("question") or "").strip():
+                raise ValueError(f"{path}:{line_number}: expected an object with a 'question'")
+            item.setdefault("id", line_number)
+            questions.append(item)
+    return questions
+
+
+def answer_item(retriever: Retriever, item: Dict[str, any], query_embedding: List[float], API_KEY: str) -> Dict[str, any]:
+    start = time.perf_counter()
+    record = {"id": item["id"], "question": item["question"]}
+    try:
+        result = answer_question(retriever, item["question"], API_KEY, filters=item.get("filters"), query_embedding=query_embedding)
+        record.update(
+            answer=result["answer"],
+            source_pages=result["source_pages"],
+            context_tokens=result.get("context_tokens"),
+            cached=result.get("cached", False),
+            timings={name: round(seconds, 4) for name, seconds in result["timings"].items()}
+        )
+    except Exception as e:
+        # One failed question should not sink the whole run
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["total_seconds"] = round(time.perf_counter() - start, 4)
+    return record
+
+
+def run_batch(input_path: str, output_path: str, API_KEY: str, workers: int = BATCH_MAX_WORKERS) -> Dict[str, any]:
+    """Answer every question in a JSONL file, writing one result line per question as it finishes."""
+    questions = read_questions(input_path)
+    if not questions:
+        print(f"No questions found in {input_path}")
+        return {"questions": 0}
+
+    retriever = Retriever(API_KEY)
+    start = time.perf_counter()
+
+    # One embed request per QUERY_EMBEDDING_BATCH_SIZE questions instead of one per question
+    print(f"Embedding {len(questions)} questions...")
+    embeddings = get_query_embeddings([item["question"] for item in questions], API_KEY)
+    embed_seconds = time.perf_counter() - start
+
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    errors = 0
+    with open(output_path, "w", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(answer_item, retriever, item, embedding, API_KEY)
+            for item, embedding in zip(questions, embeddings)
+        ]
+        # Results are streamed in completion order, the id ties them back to the input
+        for done, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            errors += "error" in record
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            if done % 10 == 0 or done == len(futures):
+                elapsed = time.perf_counter() - start
+                print(f"Progress: {done}/{len(futures)} answered, {errors} errors, {done / elapsed:.2f} questions/sec")
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "questions": len(questions),
+        "errors": errors,
+        "embed_seconds": embed_seconds,
+        "total_seconds": elapsed,
+        "questions_per_sec": len(questions) / elapsed if elapsed else None
+    }
+    if ANSWER_CACHE_ENABLED:
+        summary["answer_cache"] = get_answer_cache().stats()
+        print(f"Answer cache: {summary['answer_cache']['hits']} hits, hit rate {summary['answer_cache']['hit_rate']:.0%}")
+    print(f"Answered {len(questions) - errors}/{len(questions)} questions in {elapsed:.1f}s, results written to {output_path}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions without the interactive prompt")
+    parser.add_argument("input", help="JSONL file, one {\"question\": ..., \"id\": ..., \"filters\": ...} per line")
+    parser.add_argument("--output", default="answers.jsonl", help="Where to write one JSON result per question")
+    parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS, help="Questions processed concurrently")
+    args = parser.parse_args()
+
+    load_dotenv()
+    API_KEY = os.getenv("GEMINI_API_KEY")
+    if not API_KEY:
+        raise ValueError("GEMINI_API_KEY not found in environment variables")
+
+    run_batch(args.input, args.output, API_KEY, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
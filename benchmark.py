@@ -0,0 +1,268 @@
+from typing import List, Dict
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import fake_genai
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    values = np.asarray(samples, dtype=np.float64) * 1000  # Report in milliseconds
+    return {
+        "count": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99))
+    }
+
+
+def make_synthetic_pdf(path: str, pages: int, seed: int = 0):
+    import fitz
+
+    rng = random.Random(seed)
+    words = ("budget revenue expenditure allocation fiscal deficit policy debt tax grant subsidy "
+             "ministry department capital recurrent transfer reserve borrowing target growth").split()
+
+    doc = fitz.open()
+    for page_num in range(1, pages + 1):
+        page = doc.new_page()
+        lines = [f"## Section {page_num // 10 + 1}.{page_num % 10}"]
+        # Roughly one page in five mentions a table, like the budget annexes
+        if page_num % 5 == 0:
+            lines.append(f"Table 1.{page_num // 10}.{page_num % 10} Allocation by department")
+        for _ in range(30):
+            lines.append(" ".join(rng.choice(words) for _ in range(12)))
+        page.insert_textbox(fitz.Rect(40, 40, 560, 800), "\n".join(lines), fontsize=9)
+    doc.save(path)
+    doc.close()
+
+
+def sample_queries(count: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    templates = [
+        "What is the {} target for the fiscal year?",
+        "How much was allocated to {} in Table 1.2.7?",
+        "Explain the policy on {} and borrowing",
+        "What does the document say about {}?"
+    ]
+    topics = ["revenue", "expenditure", "deficit", "debt", "subsidy", "capital", "grant", "tax"]
+    return [rng.choice(templates).format(rng.choice(topics)) for _ in range(count)]
+
+
+def bench_indexing(pdf_path: str) -> Dict[str, any]:
+    import fitz
+    from indexing import index_pdf
+
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+
+    start = time.perf_counter()
+    _, chunk_count = index_pdf(pdf_path, "offline")
+    elapsed = time.perf_counter() - start
+
+    return {
+        "pdf": os.path.basename(pdf_path),
+        "pages": page_count,
+        "chunks": chunk_count,
+        "seconds": elapsed,
+        "pages_per_sec": page_count / elapsed if elapsed else None,
+        "chunks_per_sec": chunk_count / elapsed if elapsed else None
+    }
+
+
+def clear_query_caches():
+    # A fresh query cache without the on-disk tier, and an empty answer cache, make every question pay in full
+    import retrieval
+    from cache import QueryEmbeddingCache
+    from pipeline import get_answer_cache
+
+    retrieval._query_cache = QueryEmbeddingCache()
+    get_answer_cache().clear()
+
+
+def bench_queries(queries: List[str]) -> Dict[str, any]:
+    from retrieval import Retriever
+    from pipeline import prepare_chunks, answer_question, get_answer_cache
+    from generate import build_context
+
+    retriever = Retriever("offline")
+
+    retrieval_samples = {"uncached": [], "cached": []}
+    end_to_end_samples = {"uncached": [], "cached": []}
+    context_samples, context_tokens = [], []
+
+    # Uncached: caches are cleared before every step, so repeated questions are not cheaper
+    for query in queries:
+        clear_query_caches()
+        start = time.perf_counter()
+        chunks, _ = prepare_chunks(retriever, query, "offline")
+        retrieval_samples["uncached"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        context = build_context(chunks)
+        context_samples.append(time.perf_counter() - start)
+        context_tokens.append(context["tokens_used"])
+
+        clear_query_caches()
+        start = time.perf_counter()
+        answer_question(retriever, query, "offline")
+        end_to_end_samples["uncached"].append(time.perf_counter() - start)
+
+    # Cached: the same questions once more after a warm-up pass, served from the query and answer caches
+    for query in queries:
+        answer_question(retriever, query, "offline")
+    for query in queries:
+        start = time.perf_counter()
+        prepare_chunks(retriever, query, "offline")
+        retrieval_samples["cached"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        answer_question(retriever, query, "offline")
+        end_to_end_samples["cached"].append(time.perf_counter() - start)
+
+    return {
+        "answer_cache": get_answer_cache().stats(),
+        "retrieval": {label: percentiles(samples) for label, samples in retrieval_samples.items()},
+        "context_build": dict(percentiles(context_samples), mean_tokens=float(np.mean(context_tokens))),
+        "end_to_end": {label: percentiles(samples) for label, samples in end_to_end_samples.items()}
+    }
+
+
+STARTUP_DRIVER = """
+import os, sys
+sys.path.insert(0, {repo_dir!r})
+import fake_genai
+fake_genai.install(embed_latency=0, generate_latency=0)
+import config
+config.EMBEDDING_PROVIDER = {provider!r}
+os.environ["GEMINI_API_KEY"] = "offline"
+import main
+main.run_chatbot()
+"""
+
+
+def time_to_prompt(command: List[str], marker: bytes = b">>>", timeout: float = 60) -> float:
+    """Seconds from launching the chat CLI until its prompt is printed; the CLI is then told to quit."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = b""
+    try:
+        while marker not in output:
+            data = os.read(process.stdout.fileno(), 4096)
+            if not data:
+                raise RuntimeError(f"Chat CLI exited before showing a prompt: {output.decode(errors='replace')[-500:]}")
+            output += data
+        elapsed = time.perf_counter() - start
+        process.communicate(b"q\n", timeout=timeout)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    return elapsed
+
+
+def bench_startup(runs: int = 5) -> Dict[str, any]:
+    """Launch-to-prompt time of main.py against the index in the current directory."""
+    import config
+
+    # Fresh interpreters, so module caches from this process do not hide import cost
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    driver = STARTUP_DRIVER.format(repo_dir=repo_dir, provider=config.EMBEDDING_PROVIDER)
+    samples = [time_to_prompt([sys.executable, "-u", "-c", driver]) for _ in range(runs)]
+
+    result = percentiles(samples)
+    result["budget_ms"] = config.STARTUP_BUDGET_SECONDS * 1000
+    result["within_budget"] = result["p50_ms"] <= result["budget_ms"]
+    return result
+
+
+def run_benchmark(pdf_path: str, query_count: int) -> Dict[str, any]:
+    fake_genai.FakeSettings.calls = {"embed_content": 0, "generate_content": 0}
+    indexing_result = bench_indexing(pdf_path)
+    query_result = bench_queries(sample_queries(query_count))
+    api_calls = dict(fake_genai.FakeSettings.calls)
+    # Measured once the index is ready, otherwise main.py would start by indexing
+    startup = bench_startup()
+    print(f"Startup to prompt: {startup['p50_ms']:.0f} ms (budget {startup['budget_ms']:.0f} ms)")
+    return dict(indexing=indexing_result, startup=startup, **query_result, api_calls=api_calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmark against a local Gemini stand-in")
+    parser.add_argument("--pdf", default="Data/Financial_Policy_Document.pdf", help="Bundled PDF to benchmark")
+    parser.add_argument("--synthetic-pages", type=int, nargs="*", default=[100], help="Sizes of synthetic PDFs to generate")
+    parser.add_argument("--queries", type=int, default=50, help="Questions per corpus")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="Simulated seconds per embed request")
+    parser.add_argument("--generate-latency", type=float, default=0.5, help="Simulated seconds per generate request")
+    parser.add_argument("--embeddings", choices=["gemini", "local"], default=None, help="Embedding provider (defaults to EMBEDDING_PROVIDER)")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    # The fake must be installed before any pipeline module imports google.generativeai
+    fake_genai.install(embed_latency=args.embed_latency, generate_latency=args.generate_latency)
+    import config
+    if args.embeddings:
+        # Same constraint: modules copy config values when they are first imported
+        config.EMBEDDING_PROVIDER = args.embeddings
+
+    pdf_path = os.path.abspath(args.pdf)
+    output_path = os.path.abspath(args.output)
+
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "settings": {
+            "embed_latency": args.embed_latency,
+            "generate_latency": args.generate_latency,
+            "queries": args.queries,
+            "embeddings": config.EMBEDDING_PROVIDER
+        },
+        "runs": []
+    }
+
+    # Each corpus is indexed into a fresh working directory (all store paths are relative)
+    original_dir = os.getcwd()
+    for label, pages in [("bundled", None)] + [(f"synthetic_{n}", n) for n in args.synthetic_pages]:
+        work_dir = tempfile.mkdtemp(prefix="bench_")
+        try:
+            os.chdir(work_dir)
+            os.makedirs("Data", exist_ok=True)
+            corpus_path = pdf_path
+            if pages is not None:
+                corpus_path = os.path.join(work_dir, f"synthetic_{pages}.pdf")
+                make_synthetic_pdf(corpus_path, pages)
+
+            print(f"\n=== Benchmark: {label} ===")
+            run = run_benchmark(corpus_path, args.queries)
+            run["corpus"] = label
+            results["runs"].append(run)
+
+            # Retriever and caches hold module-level state, reset it between corpora
+            import retrieval
+            import pipeline
+            import embeddings
+            retrieval._retrievers.clear()
+            embeddings._providers.clear()
+            retrieval._query_cache = None
+            pipeline._answer_cache = None
+        finally:
+            os.chdir(original_dir)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
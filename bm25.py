@@ -0,0 +1,164 @@
+from typing import List, Dict, Iterable, Tuple
+import json
+import os
+import re
+from collections import Counter
+import numpy as np
+from vector_store import matches_filters
+from config import *
+
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[a-z0-9]+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    # Dotted numbers like 1.2.7 stay one token so table ids match exactly
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """BM25 inverted index stored as flat NumPy posting arrays.
+
+    Chunk texts are not kept, search results carry ids and metadata and the caller reads texts from the vector store.
+    """
+
+    def __init__(self, ids: List[str], metadatas: List[Dict[str, any]], vocab: Dict[str, int],
+                 term_offsets: np.ndarray, postings_docs: np.ndarray, postings_tf: np.ndarray,
+                 doc_lengths: np.ndarray, k1: float = BM25_K1, b: float = BM25_B):
+        self.ids = ids
+        self.metadatas = metadatas
+        self.vocab = vocab
+        self.term_offsets = term_offsets  # postings for term t live in [offsets[t], offsets[t + 1])
+        self.postings_docs = postings_docs
+        self.postings_tf = postings_tf
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self._filter_masks = {}
+
+        doc_count = len(ids)
+        doc_freq = np.diff(term_offsets).astype(np.float32)
+        self.idf = np.log(1.0 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+        avg_length = float(doc_lengths.mean()) if doc_count else 0.0
+        # Per-document length normalization is query independent, so precompute it
+        self.length_norm = (k1 * (1 - b + b * doc_lengths / avg_length)).astype(np.float32) if avg_length else np.zeros(doc_count, dtype=np.float32)
+
+    @classmethod
+    def build(cls, chunks: Iterable[Tuple[str, str, Dict[str, any]]]) -> "BM25Index":
+        """Index (id, text, metadata) triples; texts are tokenized as they stream past and not retained."""
+        ids, metadatas, lengths = [], [], []
+        vocab = {}
+        postings = []  # per term: list of (doc, tf)
+
+        for doc_idx, (chunk_id, text, metadata) in enumerate(chunks):
+            ids.append(chunk_id)
+            metadatas.append(metadata)
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_idx = vocab.get(term)
+                if term_idx is None:
+                    term_idx = vocab[term] = len(postings)
+                    postings.append([])
+                postings[term_idx].append((doc_idx, tf))
+
+        term_offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(p) for p in postings])
+        postings_docs = np.fromiter((doc for p in postings for doc, _ in p), dtype=np.int32, count=int(term_offsets[-1]))
+        postings_tf = np.fromiter((tf for p in postings for _, tf in p), dtype=np.float32, count=int(term_offsets[-1]))
+
+        return cls(ids, metadatas, vocab, term_offsets, postings_docs, postings_tf, np.array(lengths, dtype=np.float32))
+
+    def score(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        term_ids = [self.vocab[t] for t in set(tokenize(query)) if t in self.vocab]
+        if not term_ids:
+            return scores
+
+        # Gather all postings for the query terms and score them in one pass
+        slices = [np.arange(self.term_offsets[t], self.term_offsets[t + 1]) for t in term_ids]
+        positions = np.concatenate(slices)
+        term_of_posting = np.repeat(term_ids, [len(s) for s in slices])
+
+        docs = self.postings_docs[positions]
+        tf = self.postings_tf[positions]
+        contributions = self.idf[term_of_posting] * tf * (self.k1 + 1) / (tf + self.length_norm[docs])
+        np.add.at(scores, docs, contributions)
+        return scores
+
+    def search(self, query: str, top_k: int = DEFAULT_TOP_K, filters: Dict[str, any] = None) -> List[Dict[str, any]]:
+        scores = self.score(query)
+        if filters:
+            scores[~self.filter_mask(filters)] = 0
+        matched = np.flatnonzero(scores > 0)
+        if matched.size == 0:
+            return []
+
+        if matched.size > top_k:
+            matched = matched[np.argpartition(-scores[matched], top_k - 1)[:top_k]]
+        ranked = matched[np.argsort(-scores[matched], kind="stable")]
+
+        return [
+            {
+                "id": self.ids[i],
+                "metadata": self.metadatas[i],
+                "score": float(scores[i])
+            }
+            for i in ranked
+        ]
+
+    def filter_mask(self, filters: Dict[str, any]) -> np.ndarray:
+        # Masks are cached per filter since the same scopes are queried repeatedly
+        key = json.dumps(filters, sort_keys=True, default=list)
+        mask = self._filter_masks.get(key)
+        if mask is None:
+            mask = np.fromiter((matches_filters(m, filters) for m in self.metadatas), dtype=bool, count=len(self.metadatas))
+            self._filter_masks[key] = mask
+        return mask
+
+    def save(self, path: str = BM25_INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        # Write both files next to the live ones and swap them in, a running retriever never reads a partial index
+        tmp_arrays = f"{path}.tmp.npz"
+        np.savez(
+            tmp_arrays,
+            term_offsets=self.term_offsets,
+            postings_docs=self.postings_docs,
+            postings_tf=self.postings_tf,
+            doc_lengths=self.doc_lengths
+        )
+        tmp_data = f"{path}.json.tmp"
+        with open(tmp_data, "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "metadatas": self.metadatas, "vocab": self.vocab}, f)
+        os.replace(tmp_arrays, f"{path}.npz")
+        os.replace(tmp_data, f"{path}.json")
+
+    @classmethod
+    def load(cls, path: str = BM25_INDEX_PATH) -> "BM25Index":
+        arrays = np.load(f"{path}.npz")
+        with open(f"{path}.json", "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # Indexes saved before texts were dropped still carry them, they are ignored
+        return cls(
+            data["ids"], data["metadatas"], data["vocab"],
+            arrays["term_offsets"], arrays["postings_docs"], arrays["postings_tf"], arrays["doc_lengths"]
+        )
+
+    @staticmethod
+    def exists(path: str = BM25_INDEX_PATH) -> bool:
+        return os.path.exists(f"{path}.npz") and os.path.exists(f"{path}.json")
+
+
+def reciprocal_rank_fusion(ranked_lists: Dict[str, List[Dict[str, any]]], k: int = RRF_K) -> List[Dict[str, any]]:
+    # Merge ranked lists by sum of 1 / (k + rank), keeping each list's own score as "<name>_score"
+    fused = {}
+    for name, results in ranked_lists.items():
+        for rank, chunk in enumerate(results, 1):
+            entry = fused.get(chunk["id"])
+            if entry is None:
+                entry = fused[chunk["id"]] = dict(chunk, score=0.0)
+            entry["score"] += 1.0 / (k + rank)
+            entry[f"{name}_score"] = chunk.get("score", 0.0)
+
+    return sorted(fused.values(), key=lambda x: x["score"], reverse=True)
@@ -0,0 +1,402 @@
+from typing import List, Dict, Optional, Tuple
+from array import array
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+from config import *
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _pack_embedding(embedding: List[float]) -> bytes:
+    return array('f', embedding).tobytes()
+
+
+def _unpack_embedding(blob: bytes) -> List[float]:
+    values = array('f')
+    values.frombytes(blob)
+    return values.tolist()
+
+
+def _open_db(db_path: str) -> sqlite3.Connection:
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return sqlite3.connect(db_path, check_same_thread=False)
+
+
+def _evict_least_recent(conn: sqlite3.Connection, table: str, max_entries: int):
+    # Drop least recently used rows beyond max_entries; the caller holds the lock and commits
+    count = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    overflow = count - max_entries
+    if overflow > 0:
+        conn.execute(
+            f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY last_used ASC LIMIT ?)",
+            (overflow,)
+        )
+
+
+def _hit_stats(hits: int, misses: int) -> Dict[str, any]:
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
+
+
+class EmbeddingCache:
+    """On-disk embedding cache keyed by (model, task_type, hash of text)."""
+
+    def __init__(self, db_path: str = EMBEDDING_CACHE_FILE, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self._conn = _open_db(db_path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                task_type TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                created_at REAL,
+                PRIMARY KEY (model, task_type, text_hash)
+            )"""
+        )
+        # Caches written before created_at existed; their rows count as created when last used
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(embeddings)")}
+        if "created_at" not in columns:
+            self._conn.execute("ALTER TABLE embeddings ADD COLUMN created_at REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, texts: List[str], model: str = EMBEDDING_MODEL, task_type: str = "retrieval_document") -> List[Optional[List[float]]]:
+        # Returns one entry per text, None where the cache has no embedding
+        hashes = [text_hash(text) for text in texts]
+        found = self._lookup(hashes, model, task_type)
+        return [found[h][0] if h in found else None for h in hashes]
+
+    def get_entry(self, text: str, model: str = EMBEDDING_MODEL, task_type: str = "retrieval_document",
+                  max_age: float = None) -> Optional[Tuple[List[float], float]]:
+        """(embedding, created_at) for one text, None if missing or older than max_age seconds."""
+        h = text_hash(text)
+        return self._lookup([h], model, task_type, max_age).get(h)
+
+    def _lookup(self, hashes: List[str], model: str, task_type: str, max_age: float = None) -> Dict[str, Tuple[List[float], float]]:
+        found = {}
+        now = time.time()
+        # Expired rows are misses; put_many replaces them with a fresh created_at
+        oldest = now - max_age if max_age else 0.0
+
+        with self._lock:
+            # Query in slices to stay under sqlite's bound parameter limit
+            unique_hashes = list(dict.fromkeys(hashes))
+            for i in range(0, len(unique_hashes), 500):
+                batch = unique_hashes[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, embedding, COALESCE(created_at, last_used) FROM embeddings "
+                    f"WHERE model = ? AND task_type = ? AND text_hash IN ({placeholders}) AND COALESCE(created_at, last_used) >= ?",
+                    [model, task_type] + batch + [oldest]
+                ).fetchall()
+                for row_hash, blob, created_at in rows:
+                    found[row_hash] = (_unpack_embedding(blob), created_at)
+
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND task_type = ? AND text_hash = ?",
+                    [(now, model, task_type, h) for h in found]
+                )
+                self._conn.commit()
+
+            hit_count = sum(1 for h in hashes if h in found)
+            self.hits += hit_count
+            self.misses += len(hashes) - hit_count
+
+        return found
+
+    def put_many(self, texts: List[str], embeddings: List[List[float]], model: str = EMBEDDING_MODEL, task_type: str = "retrieval_document"):
+        now = time.time()
+        rows = [
+            (model, task_type, text_hash(text), _pack_embedding(embedding), now, now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, task_type, text_hash, embedding, last_used, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            _evict_least_recent(self._conn, "embeddings", self.max_entries)
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> Dict[str, any]:
+        return {**_hit_stats(self.hits, self.misses), "entries": len(self)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TableCache:
+    """On-disk cache of vision table extractions keyed by a hash of the rendered page."""
+
+    def __init__(self, cache_dir: str = TABLE_CACHE_DIR, model: str = TABLE_EXTRACTION_MODEL):
+        self.cache_dir = cache_dir
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, image_bytes: bytes) -> str:
+        digest = hashlib.sha256(self.model.encode("utf-8"))
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.md")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            self.hits += 1
+            return f.read()
+
+    def put(self, key: str, text: str):
+        # Atomic write so a crash never leaves a truncated entry behind
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+def normalize_query(query: str) -> str:
+    # Case, punctuation and whitespace differences should map to the same key
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+
+class QueryEmbeddingCache:
+    """In-memory LRU of query embeddings with TTL and an optional persistent tier."""
+
+    def __init__(self, capacity: int = QUERY_CACHE_SIZE, ttl_seconds: float = QUERY_CACHE_TTL_SECONDS, persistent: EmbeddingCache = None):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.persistent = persistent
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # normalized query -> (embedding, stored_at)
+        self._lock = threading.Lock()
+
+    def get(self, query: str) -> Optional[List[float]]:
+        key = normalize_query(query)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                embedding, stored_at = entry
+                if self.ttl_seconds and time.time() - stored_at > self.ttl_seconds:
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+
+        # Fall back to the on-disk tier, which applies the same TTL, and promote the entry with its original age
+        if self.persistent is not None:
+            entry = self.persistent.get_entry(key, task_type="retrieval_query", max_age=self.ttl_seconds)
+            if entry is not None:
+                embedding, created_at = entry
+                self._store(key, embedding, created_at)
+                with self._lock:
+                    self.hits += 1
+                return embedding
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, query: str, embedding: List[float]):
+        key = normalize_query(query)
+        self._store(key, embedding)
+        if self.persistent is not None:
+            self.persistent.put_many([key], [embedding], task_type="retrieval_query")
+
+    def _store(self, key: str, embedding: List[float], stored_at: float = None):
+        with self._lock:
+            self._entries[key] = (embedding, stored_at or time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, any]:
+        return {**_hit_stats(self.hits, self.misses), "entries": len(self._entries)}
+
+
+def answer_bucket(chunk_ids: List[str], history: str, index_version: str) -> str:
+    # Answers are only comparable when built from the same chunks, history and index
+    history_fingerprint = text_hash(history) if history else ""
+    return text_hash("\n".join([index_version or "", history_fingerprint] + sorted(chunk_ids)))
+
+
+class AnswerCache:
+    """Semantic answer cache: an in-memory LRU plus an optional SQLite tier.
+
+    A stored answer is reused for a new query whose embedding is within similarity_threshold
+    (cosine) of the cached query, provided the retrieved chunk ids, the conversation history and
+    the index version are the same. Entries from other index versions are dropped on first use.
+    """
+
+    def __init__(self, capacity: int = ANSWER_CACHE_SIZE, similarity_threshold: float = ANSWER_CACHE_SIMILARITY,
+                 db_path: Optional[str] = ANSWER_CACHE_FILE, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.capacity = capacity
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.index_version = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # entry id -> (bucket, normalized embedding, result)
+        self._buckets = {}  # bucket -> set of entry ids in memory
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+        self._conn = None
+        if db_path:
+            self._conn = _open_db(db_path)
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS answers (
+                    bucket TEXT NOT NULL,
+                    index_version TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    result TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_bucket ON answers (bucket)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_used ON answers (last_used)")
+            self._conn.commit()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _check_version(self, index_version: str):
+        # Called with the lock held; a rebuilt index invalidates every stored answer
+        if index_version == self.index_version:
+            return
+        self.index_version = index_version
+        self._entries.clear()
+        self._buckets.clear()
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM answers WHERE index_version != ?", (index_version or "",))
+            self._conn.commit()
+
+    def get(self, query_embedding: List[float], chunk_ids: List[str], history: str, index_version: str) -> Optional[Dict[str, any]]:
+        bucket = answer_bucket(chunk_ids, history, index_version)
+        query = self._normalize(query_embedding)
+
+        with self._lock:
+            self._check_version(index_version)
+
+            entry_ids = list(self._buckets.get(bucket, ()))
+            if entry_ids:
+                similarities = np.stack([self._entries[i][1] for i in entry_ids]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self._entries.move_to_end(entry_ids[best])
+                    self.hits += 1
+                    return dict(self._entries[entry_ids[best]][2])
+
+            # Fall back to the on-disk tier and promote the entry
+            if self._conn is not None:
+                rows = self._conn.execute("SELECT rowid, embedding, result FROM answers WHERE bucket = ?", (bucket,)).fetchall()
+                if rows:
+                    embeddings = np.stack([self._normalize(_unpack_embedding(blob)) for _, blob, _ in rows])
+                    similarities = embeddings @ query
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        rowid, _, result_json = rows[best]
+                        self._conn.execute("UPDATE answers SET last_used = ? WHERE rowid = ?", (time.time(), rowid))
+                        self._conn.commit()
+                        result = json.loads(result_json)
+                        self._store(bucket, embeddings[best], result)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return dict(result)
+
+            self.misses += 1
+        return None
+
+    def put(self, query_embedding: List[float], chunk_ids: List[str], history: str, index_version: str, result: Dict[str, any]):
+        bucket = answer_bucket(chunk_ids, history, index_version)
+        embedding = self._normalize(query_embedding)
+
+        with self._lock:
+            self._check_version(index_version)
+            self._store(bucket, embedding, result)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT INTO answers (bucket, index_version, embedding, result, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (bucket, index_version or "", _pack_embedding(embedding.tolist()), json.dumps(result), time.time())
+                )
+                _evict_least_recent(self._conn, "answers", self.max_entries)
+                self._conn.commit()
+
+    def _store(self, bucket: str, embedding: np.ndarray, result: Dict[str, any]):
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (bucket, embedding, result)
+        self._buckets.setdefault(bucket, set()).add(entry_id)
+        while len(self._entries) > self.capacity:
+            old_id, (old_bucket, _, _) = self._entries.popitem(last=False)
+            self._buckets[old_bucket].discard(old_id)
+            if not self._buckets[old_bucket]:
+                del self._buckets[old_bucket]
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM answers")
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, any]:
+        with self._lock:
+            disk_entries = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] if self._conn is not None else 0
+            return {
+                **_hit_stats(self.hits, self.misses),
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "disk_entries": disk_entries
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
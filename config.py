@@ -1,17 +1,54 @@
 # File paths
 PDF_FILE_PATH = "Data/Financial_Policy_Document.pdf"
 CHROMA_DB_PATH = "./chroma_db"
+INDEX_VERSION_FILE = "./chroma_db/index_version.json"
+BM25_INDEX_PATH = "./chroma_db/bm25_index"  # .npz postings + .json sidecar
+TABLE_STORE_FILE = "./chroma_db/tables.sqlite3"  # Parsed tables and typed cells
 EXTRACTED_CONTENT_FILE = "Data/extracted_content.md"
+CACHE_DIR = "./cache"
+EMBEDDING_CACHE_FILE = "./cache/embeddings.sqlite3"
+TABLE_CACHE_DIR = "./cache/tables"
+CHECKPOINT_FILE = "./cache/checkpoints.sqlite3"  # Per-page extraction checkpoints for resumable indexing
 
 
 # Model configs
 EMBEDDING_MODEL = "models/gemini-embedding-001"
 GENERATION_MODEL = "models/gemini-2.5-flash"
 TABLE_EXTRACTION_MODEL = "models/gemini-2.5-flash"
+# "gemini" embeds with EMBEDDING_MODEL over the network, "local" with a CPU-only
+# hashed TF-IDF + SVD model fitted on the indexed corpus (re-index with --rebuild after switching)
+EMBEDDING_PROVIDER = "gemini"
+LOCAL_EMBEDDING_MODEL_FILE = "./chroma_db/local_embedding.npz"
+LOCAL_EMBEDDING_DIMENSION = 256
+LOCAL_EMBEDDING_HASH_BITS = 22  # Unigrams and bigrams are hashed into 2^22 buckets
+LOCAL_EMBEDDING_MAX_FEATURES = 32768  # Most widespread features kept by the fit
+LOCAL_EMBEDDING_MAX_FIT_TEXTS = 20000  # Larger corpora are fitted on an even sample of chunks
 
 
 # DB configs
+VECTOR_STORE_BACKEND = "chroma"  # "chroma" or "numpy" (memory-mapped exact search)
+NUMPY_STORE_DIR = "./chroma_db/numpy_store"
+NUMPY_STORE_DTYPE = "float32"  # "float16" halves the file size
 COLLECTION_NAME = "financial_policy_documents"
+# Streaming indexing pipeline
+PAGE_WINDOW_SIZE = 8  # Pages extracted per pymupdf4llm call
+PIPELINE_QUEUE_SIZE = 16  # Extracted pages buffered ahead of embedding
+INDEX_PIPELINE_BATCH_SIZE = 100  # Chunks embedded and upserted together
+INDEX_CHECKPOINTS = True  # Reuse checkpointed pages instead of extracting them again
+# Max records per upsert/delete call
+INDEX_WRITE_BATCH_SIZE = 500
+
+
+# Gemini quota and retry configs
+GEMINI_REQUESTS_PER_MINUTE = {
+    EMBEDDING_MODEL: 3000,
+    GENERATION_MODEL: 1000,  # Shared with TABLE_EXTRACTION_MODEL when they are the same model
+}
+GEMINI_DEFAULT_REQUESTS_PER_MINUTE = 600
+GEMINI_MAX_CONCURRENCY = 8  # Upper bound per model, lowered automatically on 429s
+GEMINI_MAX_RETRIES = 5
+GEMINI_BACKOFF_BASE_SECONDS = 1.0
+GEMINI_BACKOFF_MAX_SECONDS = 60.0
 
 
 # Chunk configs
@@ -19,16 +56,89 @@ DEFAULT_CHUNK_SIZE = 1000
 DEFAULT_CHUNK_OVERLAP = 200
 # Embedding batch size for gemini rate limit
 EMBEDDING_BATCH_SIZE = 10
+# Number of embedding batches in flight at once
+EMBEDDING_MAX_CONCURRENCY = 4
+# Max embeddings kept in the on-disk cache (least recently used are evicted)
+EMBEDDING_CACHE_MAX_ENTRIES = 50000
+# Number of table pages sent to Gemini Vision at once
+TABLE_EXTRACTION_MAX_WORKERS = 4
+TABLE_REGION_PADDING = 6  # Points added around each detected table
+TABLE_CAPTION_MARGIN = 36  # Points above a table included to catch its "Table X.X.X" caption
+TABLE_TARGET_GLYPH_PX = 20  # Rendered pixel height of the table's median font size
+TABLE_MIN_ZOOM = 1.0
+TABLE_MAX_ZOOM = 3.0
+TABLE_MAX_PIXELS = 4_000_000  # Per rendered region
 
 
 # Retrieve config
 DEFAULT_TOP_K = 5
 MAX_CHUNKS_FOR_GENERATION = 5
+# Context packing
+CONTEXT_TOKEN_BUDGET = 1000  # Max tokens of retrieved context per prompt
+MMR_LAMBDA = 0.7  # 1.0 = pure relevance, 0.0 = pure novelty
+CHARS_PER_TOKEN = 4  # Used to estimate token counts without a tokenizer
 DEFAULT_SIMILARITY_THRESHOLD = 0.9
+# Dedup switches from the embedding cosine matrix to MinHash above this many candidates
+DEDUP_MINHASH_MIN_CANDIDATES = 200
+MINHASH_NUM_PERM = 64
+SHINGLE_SIZE = 5  # Words per shingle
+# Hybrid retrieval (BM25 + vector, merged by reciprocal rank fusion)
+HYBRID_RETRIEVAL = True
+HYBRID_CANDIDATE_MULTIPLIER = 2  # Each retriever returns top_k * multiplier candidates before fusion
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+# Query embedding cache
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_TTL_SECONDS = 24 * 60 * 60
+QUERY_CACHE_PERSIST = True  # Also keep query embeddings in the on-disk embedding cache
+
+
+# Answer cache config
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_SIZE = 512  # Answers kept in memory
+ANSWER_CACHE_SIMILARITY = 0.95  # Minimum cosine between query embeddings to reuse an answer
+ANSWER_CACHE_FILE = "./cache/answers.sqlite3"  # On-disk tier, None keeps answers in memory only
+ANSWER_CACHE_MAX_ENTRIES = 10000
+
+
+# Table lookup config
+TABLE_LOOKUP = True  # Answer questions naming a table or row label from the parsed table store
+TABLE_LOOKUP_MAX_ROWS = 12
+TABLE_LOOKUP_MAX_TABLES = 3
+TABLE_ROW_MATCH_THRESHOLD = 0.5  # Share of a row label's words the question must contain
+TABLE_FASTPATH_TEXT_CHUNKS = 2  # Text chunks sent along with matched table rows
 
 
 # Memory config
 MEMORY_WINDOW_SIZE = 5  # Keep last 5 conversation pairs
+MEMORY_MODE = "window"  # "window" keeps the last MEMORY_WINDOW_SIZE pairs verbatim, "summary" folds older pairs within a token budget
+MEMORY_TOKEN_BUDGET = 1200  # Upper bound for history in each prompt (summary mode)
+MEMORY_SUMMARY_RESERVE_TOKENS = 300  # Part of the budget the verbatim turns never take, so the summary survives a long answer
+MEMORY_RECENT_TURNS = 2  # Most recent pairs kept verbatim, older ones are summarized
+MEMORY_SUMMARY_SENTENCES = 2  # Lead sentences of an answer kept in its summary line
+MEMORY_SUMMARY_MAX_CHARS = 400
+MEMORY_SESSION_DIR = "./cache/sessions"  # Persisted conversations, one JSON file per session
+MEMORY_PERSIST_SESSIONS = True  # Server sessions resume from disk after a restart, until SERVER_SESSION_TTL_SECONDS idle
+
+
+# Batch config
+BATCH_MAX_WORKERS = 8  # Questions in flight at once, the Gemini limiter still enforces quotas
+QUERY_EMBEDDING_BATCH_SIZE = 100  # Queries per embed request in batch mode
+
+
+# Server config
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8000
+SERVER_MAX_CONCURRENCY = 16  # Questions processed at once across all sessions
+SERVER_SESSION_TTL_SECONDS = 60 * 60  # Idle sessions are dropped after this, persisted ones too
+SERVER_SESSION_DIR = "./cache/sessions/server"  # Server sessions, kept apart from CLI sessions so only they expire
+SERVER_SESSION_SWEEP_SECONDS = 60  # How often persisted server sessions are checked for expiry
+
+
+# Profiling
+PROFILE_OUTPUT_FILE = "profile.jsonl"  # Traces from --profile runs are appended here
+STARTUP_BUDGET_SECONDS = 0.5  # Time from launch to the chat prompt when the index is ready
 
 
 # Misc. 
@@ -0,0 +1,290 @@
+from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import os
+import threading
+import time
+import zlib
+import numpy as np
+import google.generativeai as genai
+from bm25 import tokenize
+from gemini_client import get_client, INTERACTIVE, BACKGROUND
+from config import *
+
+# Indexes built before the model was recorded were always embedded with Gemini
+LEGACY_EMBEDDING_MODEL = f"gemini:{EMBEDDING_MODEL}"
+
+
+class EmbeddingProvider:
+    """Interface shared by the Gemini and local embedding backends."""
+
+    name = ""
+    cache_embeddings = False  # Whether results are worth keeping in the embedding caches
+    trainable = False  # Whether the model is fitted on the corpus before indexing
+    fitted = True
+
+    @property
+    def model(self) -> str:
+        # "<provider>:<model>", recorded with the index so mismatched models are rejected
+        raise NotImplementedError
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    def embed_query(self, query: str) -> List[float]:
+        return self.embed_queries([query])[0]
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+
+class GeminiEmbeddingProvider(EmbeddingProvider):
+    """Remote EMBEDDING_MODEL calls through the shared Gemini client."""
+
+    name = "gemini"
+    cache_embeddings = True
+
+    def __init__(self, model: str = EMBEDDING_MODEL):
+        self.model_name = model
+
+    @property
+    def model(self) -> str:
+        return f"{self.name}:{self.model_name}"
+
+    def _embed(self, content, task_type: str, priority: int):
+        # embed_content accepts a single text or a list of texts
+        result = get_client().call(
+            self.model_name,
+            genai.embed_content,
+            model=self.model_name,
+            content=content,
+            task_type=task_type,
+            priority=priority
+        )
+        return result['embedding']
+
+    def embed_documents(self, texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE, max_concurrency: int = EMBEDDING_MAX_CONCURRENCY) -> List[List[float]]:
+        if not texts:
+            return []
+
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        results = [None] * len(batches)
+
+        start_time = time.perf_counter()
+
+        # Keep several batches in flight, results are slotted back by batch index
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            futures = {executor.submit(self._embed, batch, "retrieval_document", BACKGROUND): idx for idx, batch in enumerate(batches)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+
+        elapsed = time.perf_counter() - start_time
+
+        embeddings = []
+        for batch_embeddings in results:
+            embeddings.extend(batch_embeddings)
+
+        throughput = len(texts) / elapsed if elapsed > 0 else float('inf')
+        print(f"Embedded {len(texts)} chunks in {elapsed:.2f}s ({throughput:.1f} chunks/sec)")
+
+        return embeddings
+
+    def embed_query(self, query: str) -> List[float]:
+        # A user is waiting on this one
+        return self._embed(query, "retrieval_query", INTERACTIVE)
+
+    def embed_queries(self, queries: List[str], batch_size: int = QUERY_EMBEDDING_BATCH_SIZE) -> List[List[float]]:
+        embeddings = []
+        for start in range(0, len(queries), batch_size):
+            embeddings.extend(self._embed(queries[start:start + batch_size], "retrieval_query", BACKGROUND))
+        return embeddings
+
+
+def hashed_features(text: str, hash_bits: int = LOCAL_EMBEDDING_HASH_BITS) -> Dict[int, int]:
+    """Counts of hashed unigrams and bigrams, using the BM25 tokenizer so table ids stay whole."""
+    mask = (1 << hash_bits) - 1
+    tokens = tokenize(text)
+    counts = {}
+    for term in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+        feature = zlib.crc32(term.encode("utf-8")) & mask
+        counts[feature] = counts.get(feature, 0) + 1
+    return counts
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """Hashed TF-IDF projected with a truncated SVD fitted on the indexed corpus; CPU only, no network."""
+
+    name = "local"
+    trainable = True
+
+    def __init__(self, path: str = LOCAL_EMBEDDING_MODEL_FILE, hash_bits: int = LOCAL_EMBEDDING_HASH_BITS):
+        self.path = path
+        self.hash_bits = hash_bits
+        self.features = None  # Sorted hashed feature ids kept by the fit
+        self.idf = None
+        self.projection = None  # features x dimension
+        self.model_id = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        # Pick up a model refitted by an indexing run, like the other index files
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self._mtime and self.projection is not None:
+            return
+        with self._lock:
+            if mtime is None:
+                raise ValueError(f"No local embedding model at {self.path}, run indexing first")
+            with np.load(self.path) as data:
+                self.features = data["features"]
+                self.idf = data["idf"]
+                self.projection = data["projection"]
+                self.model_id = str(data["model_id"])
+            self._mtime = mtime
+
+    @property
+    def fitted(self) -> bool:
+        return self.projection is not None or os.path.exists(self.path)
+
+    @property
+    def model(self) -> str:
+        self._ensure_loaded()
+        return self.model_id
+
+    def _weights(self, text: str):
+        # Sublinear TF-IDF over the kept features, L2-normalized; returns (columns, weights)
+        counts = hashed_features(text, self.hash_bits)
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        hashed = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        columns = np.searchsorted(self.features, hashed)
+        known = (columns < len(self.features)) & (self.features[np.minimum(columns, len(self.features) - 1)] == hashed)
+        columns = columns[known]
+        weights = (1 + np.log(tf[known])) * self.idf[columns]
+        norm = float(np.linalg.norm(weights))
+        return columns, weights / norm if norm else weights
+
+    def _embed(self, text: str) -> List[float]:
+        columns, weights = self._weights(text)
+        vector = weights @ self.projection[columns] if len(columns) else np.zeros(self.projection.shape[1], dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._ensure_loaded()
+        return [self._embed(text) for text in texts]
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        self._ensure_loaded()
+        return [self._embed(query) for query in queries]
+
+    def fit(self, texts: List[str], dimension: int = LOCAL_EMBEDDING_DIMENSION, max_features: int = LOCAL_EMBEDDING_MAX_FEATURES,
+            max_texts: int = LOCAL_EMBEDDING_MAX_FIT_TEXTS, seed: int = 0):
+        """Fit the TF-IDF weights and SVD projection on the corpus and write the model file."""
+        start = time.perf_counter()
+        texts = [text for text in texts if text.strip()]
+        if not texts:
+            raise ValueError("No text to fit the local embedding model on")
+        if len(texts) > max_texts:
+            # An even sample keeps every part of the corpus represented
+            texts = [texts[i] for i in np.linspace(0, len(texts) - 1, max_texts).astype(int)]
+
+        # Sparse document-term matrix in coordinate form over hashed features
+        rows, hashed, tf = [], [], []
+        for row, text in enumerate(texts):
+            counts = hashed_features(text, self.hash_bits)
+            rows.extend([row] * len(counts))
+            hashed.extend(counts.keys())
+            tf.extend(counts.values())
+        rows = np.array(rows, dtype=np.int64)
+        hashed = np.array(hashed, dtype=np.int64)
+        tf = np.array(tf, dtype=np.float32)
+
+        # Keep the most widespread features, each row already counts a feature once
+        features, columns = np.unique(hashed, return_inverse=True)
+        df = np.bincount(columns, minlength=len(features))
+        if len(features) > max_features:
+            kept = np.sort(np.argsort(-df, kind="stable")[:max_features])
+            remap = np.full(len(features), -1, dtype=np.int64)
+            remap[kept] = np.arange(len(kept))
+            keep = remap[columns] >= 0
+            rows, columns, tf = rows[keep], remap[columns[keep]], tf[keep]
+            features, df = features[kept], df[kept]
+
+        n_texts, n_features = len(texts), len(features)
+        idf = (np.log((1 + n_texts) / (1 + df)) + 1).astype(np.float32)
+        values = (1 + np.log(tf)) * idf[columns]
+        norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=n_texts))
+        values = (values / np.maximum(norms[rows], 1e-12)).astype(np.float32)
+
+        def matmul(matrix: np.ndarray) -> np.ndarray:
+            # X @ matrix for the sparse X
+            return np.stack([np.bincount(rows, weights=values * matrix[columns, j], minlength=n_texts) for j in range(matrix.shape[1])], axis=1)
+
+        def rmatmul(matrix: np.ndarray) -> np.ndarray:
+            # X.T @ matrix
+            return np.stack([np.bincount(columns, weights=values * matrix[rows, j], minlength=n_features) for j in range(matrix.shape[1])], axis=1)
+
+        # Randomized truncated SVD (Halko et al.) with two power iterations
+        dimension = min(dimension, n_texts, n_features)
+        oversampled = min(dimension + 10, n_texts, n_features)
+        rng = np.random.default_rng(seed)
+        basis = np.linalg.qr(matmul(rng.standard_normal((n_features, oversampled))))[0]
+        for _ in range(2):
+            basis = np.linalg.qr(matmul(np.linalg.qr(rmatmul(basis))[0]))[0]
+        # X.T @ Q = U s Vt, so the leading columns of U are the top right singular vectors of X
+        left, _, _ = np.linalg.svd(rmatmul(basis), full_matrices=False)
+        projection = np.ascontiguousarray(left[:, :dimension], dtype=np.float32)
+
+        digest = hashlib.sha256(features.tobytes())
+        digest.update(projection.tobytes())
+        model_id = f"{self.name}:hashed-tfidf-svd-{dimension}:{digest.hexdigest()[:12]}"
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Written next to the live file and swapped in, readers never load a half-written model
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, features=features, idf=idf, projection=projection, model_id=np.array(model_id))
+        os.replace(tmp_path, self.path)
+
+        with self._lock:
+            self.features, self.idf, self.projection, self.model_id = features, idf, projection, model_id
+            self._mtime = os.path.getmtime(self.path)
+        print(f"Fitted local embedding model on {n_texts} chunks ({n_features} features, {dimension} dimensions) in {time.perf_counter() - start:.2f}s")
+        return model_id
+
+
+def check_embedding_model(recorded: Optional[str], provider: EmbeddingProvider):
+    """Reject an index whose vectors came from a different embedding model than the configured one."""
+    recorded = recorded or LEGACY_EMBEDDING_MODEL
+    current = provider.model if provider.fitted else f"{provider.name} (no fitted model)"
+    if recorded != current:
+        raise ValueError(
+            f"The index was built with embedding model '{recorded}' but '{current}' is configured, "
+            f"re-run indexing with --rebuild"
+        )
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_embedding_provider(API_KEY: str = None, name: str = EMBEDDING_PROVIDER) -> EmbeddingProvider:
+    if name == "gemini" and API_KEY:
+        genai.configure(api_key=API_KEY)
+    with _providers_lock:
+        provider = _providers.get(name)
+        if provider is None:
+            if name == "gemini":
+                provider = GeminiEmbeddingProvider()
+            elif name == "local":
+                provider = LocalEmbeddingProvider()
+            else:
+                raise ValueError(f"Unknown embedding provider: {name}")
+            _providers[name] = provider
+        return provider
@@ -0,0 +1,133 @@
+from typing import List, Dict
+import hashlib
+import re
+import sys
+import time
+import types
+import numpy as np
+
+
+class FakeSettings:
+    embed_latency = 0.05  # Seconds per embed_content request
+    generate_latency = 0.5  # Seconds per generate_content call
+    token_latency = 0.01  # Seconds between streamed chunks
+    dimension = 768
+    calls = {"embed_content": 0, "generate_content": 0}
+
+
+def _embed_text(text: str, dimension: int) -> List[float]:
+    # Bag of hashed words, so texts sharing words get similar vectors
+    vector = np.zeros(dimension, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dimension
+        vector[index] += 1.0 if digest[4] % 2 else -1.0
+    norm = float(np.linalg.norm(vector))
+    if norm:
+        vector /= norm
+    return vector.tolist()
+
+
+def configure(api_key: str = None, **kwargs):
+    pass
+
+
+def embed_content(model: str, content, task_type: str = None, **kwargs) -> Dict[str, any]:
+    FakeSettings.calls["embed_content"] += 1
+    time.sleep(FakeSettings.embed_latency)
+    if isinstance(content, (list, tuple)):
+        return {"embedding": [_embed_text(text, FakeSettings.dimension) for text in content]}
+    return {"embedding": _embed_text(content, FakeSettings.dimension)}
+
+
+class GenerationConfig:
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _Part:
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _Response:
+
+    def __init__(self, text: str, prompt_tokens: int = 0, output_tokens: int = None):
+        self.text = text
+        content = types.SimpleNamespace(parts=[_Part(text)] if text else [])
+        self.candidates = [types.SimpleNamespace(content=content)]
+        self.usage_metadata = types.SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=len(text) // 4 if output_tokens is None else output_tokens
+        )
+
+
+class _StreamingResponse:
+
+    def __init__(self, text: str, prompt_tokens: int = 0):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        words = text.split(" ")
+        self._pieces = [" ".join(words[i:i + 8]) + " " for i in range(0, len(words), 8)]
+
+    def __iter__(self):
+        for i, piece in enumerate(self._pieces):
+            time.sleep(FakeSettings.token_latency)
+            # Like the real API, the last chunk reports usage for the whole response
+            if i == len(self._pieces) - 1:
+                yield _Response(piece, self.prompt_tokens, len(self.text) // 4)
+            else:
+                yield _Response(piece)
+
+
+class GenerativeModel:
+
+    def __init__(self, model_name: str = None, **kwargs):
+        self.model_name = model_name
+
+    def _answer(self, contents) -> str:
+        if isinstance(contents, (list, tuple)):
+            # Vision table extraction: [prompt, image]
+            return (
+                "---TABLE_START---\n### Table 1.1.1 Synthetic Allocation\n"
+                "|Item|FY23|FY24|\n|-|-|-|\n|Revenue|100|110|\n|Expenditure|120|125|\n"
+                "---TABLE_END---\nSummary of Table 1.1.1: revenue and expenditure by year."
+            )
+        pages = sorted(set(re.findall(r"\[Page (\d+)\]", contents)))[:3]
+        citations = ", ".join(f"**[Page {page}]**" for page in pages) or "the document"
+        return f"Based on the provided context, the answer can be found in {citations}. " + "Further detail follows. " * 40
+
+    def generate_content(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        FakeSettings.calls["generate_content"] += 1
+        time.sleep(FakeSettings.generate_latency)
+        text = self._answer(contents)
+        prompt_tokens = len(contents) // 4 if isinstance(contents, str) else 0
+        return _StreamingResponse(text, prompt_tokens) if stream else _Response(text, prompt_tokens)
+
+    def count_tokens(self, contents) -> types.SimpleNamespace:
+        text = contents if isinstance(contents, str) else " ".join(map(str, contents))
+        return types.SimpleNamespace(total_tokens=len(text) // 4)
+
+
+def install(embed_latency: float = None, generate_latency: float = None, token_latency: float = None):
+    """Replace google.generativeai in sys.modules; must run before the pipeline modules are imported."""
+    if embed_latency is not None:
+        FakeSettings.embed_latency = embed_latency
+    if generate_latency is not None:
+        FakeSettings.generate_latency = generate_latency
+    if token_latency is not None:
+        FakeSettings.token_latency = token_latency
+
+    module = sys.modules[__name__]
+    # Keep the real google namespace package so google.protobuf etc. still import
+    try:
+        import google
+    except ImportError:
+        google = types.ModuleType("google")
+        google.__path__ = []
+    google.generativeai = module
+    sys.modules["google"] = google
+    sys.modules["google.generativeai"] = module
+    return module
@@ -0,0 +1,176 @@
+from typing import Callable, Dict, Iterator
+import random
+import threading
+import time
+from config import *
+
+INTERACTIVE = 0  # User-facing queries, served first
+BACKGROUND = 1  # Indexing work, yields to interactive calls
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_overloaded(code: int) -> bool:
+    # Rate limiting and server errors both mean the API wants fewer requests in flight
+    return code == 429 or 500 <= code < 600
+
+
+def status_code(error: Exception) -> int:
+    # google.api_core exceptions carry the HTTP status as .code
+    code = getattr(error, "code", None)
+    if callable(code):
+        code = None
+    if isinstance(code, int):
+        return code
+    if type(error).__name__ in ("ResourceExhausted", "TooManyRequests"):
+        return 429
+    if type(error).__name__ in ("ServiceUnavailable", "InternalServerError", "DeadlineExceeded"):
+        return 503
+    return 0
+
+
+class ModelLimiter:
+    """Token bucket for a per-minute request quota plus an adaptive (AIMD) concurrency limit."""
+
+    def __init__(self, requests_per_minute: int, max_concurrency: int = GEMINI_MAX_CONCURRENCY):
+        self.rate = requests_per_minute / 60.0
+        # Allow bursts of up to ten seconds' worth of quota
+        self.capacity = max(1.0, self.rate * 10)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = max_concurrency
+        self.in_flight = 0
+        self.success_streak = 0
+        self.throttled_count = 0
+        self.waiting_interactive = 0
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, priority: int = INTERACTIVE):
+        with self._condition:
+            if priority == INTERACTIVE:
+                self.waiting_interactive += 1
+            try:
+                while True:
+                    self._refill()
+                    yields_to_interactive = priority == BACKGROUND and self.waiting_interactive > 0
+                    if not yields_to_interactive and self.in_flight < self.concurrency_limit and self.tokens >= 1:
+                        self.tokens -= 1
+                        self.in_flight += 1
+                        return
+                    # Sleep until a token is due, or until a release wakes us
+                    timeout = (1 - self.tokens) / self.rate if self.tokens < 1 else None
+                    self._condition.wait(timeout)
+            finally:
+                if priority == INTERACTIVE:
+                    self.waiting_interactive -= 1
+                    self._condition.notify_all()
+
+    def release(self, throttled: bool = False, succeeded: bool = True):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                # Multiplicative decrease on 429 or 5xx, additive increase after a clean streak
+                self.throttled_count += 1
+                self.concurrency_limit = max(1, self.concurrency_limit // 2)
+                self.success_streak = 0
+            elif succeeded:
+                self.success_streak += 1
+                if self.success_streak >= self.concurrency_limit and self.concurrency_limit < self.max_concurrency:
+                    self.concurrency_limit += 1
+                    self.success_streak = 0
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, any]:
+        with self._condition:
+            return {
+                "concurrency_limit": self.concurrency_limit,
+                "in_flight": self.in_flight,
+                "tokens": round(self.tokens, 2),
+                "throttled": self.throttled_count
+            }
+
+
+class GeminiClient:
+    """Single entry point for Gemini calls: per-model quotas, priorities, and retries with backoff."""
+
+    def __init__(self, requests_per_minute: Dict[str, int] = GEMINI_REQUESTS_PER_MINUTE, max_retries: int = GEMINI_MAX_RETRIES):
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, model: str) -> ModelLimiter:
+        with self._lock:
+            limiter = self._limiters.get(model)
+            if limiter is None:
+                rpm = self.requests_per_minute.get(model, GEMINI_DEFAULT_REQUESTS_PER_MINUTE)
+                limiter = self._limiters[model] = ModelLimiter(rpm)
+            return limiter
+
+    def _run(self, limiter: ModelLimiter, model: str, fn: Callable, args, kwargs, priority: int):
+        # Returns fn's result with the limiter slot still held; the caller releases it
+        attempt = 0
+        while True:
+            limiter.acquire(priority)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                code = status_code(e)
+                # Only completed calls grow the concurrency limit, other failures leave it unchanged
+                limiter.release(throttled=is_overloaded(code), succeeded=False)
+                if code not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+                    raise
+
+            # Full jitter keeps many retrying workers from hitting the API in lockstep
+            delay = random.uniform(0, min(GEMINI_BACKOFF_MAX_SECONDS, GEMINI_BACKOFF_BASE_SECONDS * 2 ** attempt))
+            print(f"Gemini {model} returned {code}, retrying in {delay:.1f}s (attempt {attempt + 1}/{self.max_retries})")
+            time.sleep(delay)
+            attempt += 1
+
+    def call(self, model: str, fn: Callable, /, *args, priority: int = INTERACTIVE, **kwargs):
+        # model is positional-only so it can also be passed through to fn as a keyword
+        limiter = self.limiter(model)
+        result = self._run(limiter, model, fn, args, kwargs, priority)
+        limiter.release()
+        return result
+
+    def stream(self, model: str, fn: Callable, /, *args, priority: int = INTERACTIVE, **kwargs) -> Iterator:
+        """Like call() for a streaming fn, but the slot is held until the stream is consumed or closed.
+
+        Only opening the stream is retried, not failures mid-stream.
+        """
+        limiter = self.limiter(model)
+        response = self._run(limiter, model, fn, args, kwargs, priority)
+        throttled, succeeded = False, False
+        try:
+            yield from response
+            succeeded = True
+        except Exception as e:
+            throttled = is_overloaded(status_code(e))
+            raise
+        finally:
+            # A stream closed early by the consumer neither grows nor shrinks the limit
+            limiter.release(throttled=throttled, succeeded=succeeded)
+
+    def stats(self) -> Dict[str, Dict[str, any]]:
+        with self._lock:
+            return {model: limiter.stats() for model, limiter in self._limiters.items()}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> GeminiClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GeminiClient()
+        return _client
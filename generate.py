@@ -1,39 +1,80 @@
-from typing import List, Dict
+from typing import List, Dict, Iterator
+from contextlib import closing
+import time
 import google.generativeai as genai
-from config import GENERATION_MODEL
+import numpy as np
+from utils import estimate_tokens, truncate_to_tokens
+import profiling
+from gemini_client import get_client, INTERACTIVE
+from config import GENERATION_MODEL, CONTEXT_TOKEN_BUDGET, MMR_LAMBDA
 
 
-def create_context(chunks: List[Dict[str, any]], max_length: int = 3000) -> str:
+def format_chunk(chunk: Dict[str, any]) -> str:
+    page = chunk.get('metadata', {}).get('page', 'Unknown')
+    # Format chunk with page reference
+    return f"[Page {page}] {chunk.get('text', '')}"
 
-    context_parts = []
-    current_length = 0
+
+def chunk_similarity(a: Dict[str, any], b: Dict[str, any]) -> float:
+    # Cosine over embeddings when both have one, word-set Jaccard otherwise
+    if a.get('embedding') is not None and b.get('embedding') is not None:
+        va = np.asarray(a['embedding'], dtype=np.float32)
+        vb = np.asarray(b['embedding'], dtype=np.float32)
+        denom = float(np.linalg.norm(va) * np.linalg.norm(vb))
+        return float(va @ vb) / denom if denom else 0.0
+    words_a = set(a.get('text', '').lower().split())
+    words_b = set(b.get('text', '').lower().split())
+    union = words_a | words_b
+    return len(words_a & words_b) / len(union) if union else 0.0
+
+
+def build_context(chunks: List[Dict[str, any]], token_budget: int = CONTEXT_TOKEN_BUDGET, mmr_lambda: float = MMR_LAMBDA) -> Dict[str, any]:
+    """Pick chunks by relevance and novelty (MMR) until the token budget is full."""
+
+    formatted = [format_chunk(chunk) for chunk in chunks]
+    costs = [estimate_tokens(text) for text in formatted]
+    total_tokens = sum(costs)
     
-    for chunk in chunks:
-        metadata = chunk.get('metadata', {})
-        page = metadata.get('page', 'Unknown')
-        text = chunk.get('text', '')
-        
-        # Format chunk with page reference
-        formatted_chunk = f"[Page {page}] {text}"
-        
-        # Check if adding this chunk would exceed max length
-        if current_length + len(formatted_chunk) > max_length:
+    # The top-ranked chunk is always included, cut down if it alone is over the budget
+    if chunks and costs[0] > token_budget:
+        formatted[0] = truncate_to_tokens(formatted[0], token_budget)
+        costs[0] = estimate_tokens(formatted[0])
+    
+    # Relevance from retrieval rank, so it works for any score scale (cosine, RRF)
+    relevance = [1.0 - i / len(chunks) for i in range(len(chunks))]
+    
+    selected = []
+    max_similarity = [0.0] * len(chunks)
+    remaining = set(range(len(chunks)))
+    tokens_used = 0
+    
+    while remaining:
+        # Chunks that no longer fit are skipped, not a reason to stop
+        fitting = [i for i in remaining if tokens_used + costs[i] <= token_budget]
+        if not fitting:
             break
+        best = max(fitting, key=lambda i: mmr_lambda * relevance[i] - (1 - mmr_lambda) * max_similarity[i])
         
-        context_parts.append(formatted_chunk)
-        current_length += len(formatted_chunk)
+        selected.append(best)
+        remaining.discard(best)
+        tokens_used += costs[best]
+        for i in remaining:
+            max_similarity[i] = max(max_similarity[i], chunk_similarity(chunks[best], chunks[i]))
     
-    return "\n\n".join(context_parts)
+    return {
+        "context": "\n\n".join(formatted[i] for i in selected),
+        "chunks": [chunks[i] for i in selected],
+        "tokens_used": tokens_used,
+        "tokens_saved": total_tokens - tokens_used
+    }
 
 
-def generate_answer(query: str, chunks: List[Dict[str, any]], API_KEY: str, conversation_history: str = "", temperature: float = 0.1) -> Dict[str, any]:
+def create_context(chunks: List[Dict[str, any]], token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    return build_context(chunks, token_budget)["context"]
 
-    genai.configure(api_key=API_KEY)
-    
-    # Create context from chunks
-    context = create_context(chunks)
-    
-    prompt = f"""You are a helpful assistant that answers questions based on a financial policy document.
+
+def build_prompt(query: str, context: str, conversation_history: str = "") -> str:
+    return f"""You are a helpful assistant that answers questions based on a financial policy document.
 
     INSTRUCTIONS:
     1. Answer ONLY based on the provided context
@@ -61,18 +102,68 @@ def generate_answer(query: str, chunks: List[Dict[str, any]], API_KEY: str, conv
     {query}
 
     ANSWER (in markdown format):"""
+
+
+def get_generation_config(temperature: float = 0.1) -> genai.GenerationConfig:
+    return genai.GenerationConfig(
+        temperature=temperature,
+        max_output_tokens=1500,
+        top_p=0.9
+    )
+
+
+def get_source_pages(chunks: List[Dict[str, any]]) -> List[int]:
+    # Extract page references from chunks for source citation
+    pages = []
+    for chunk in chunks:
+        page = chunk.get('metadata', {}).get('page', None)
+        if page and page not in pages:
+            pages.append(page)
+    
+    return sorted(pages) if pages else []
+
+
+_generation_model = None
+
+
+def get_generation_model() -> genai.GenerativeModel:
+    # One model client shared by every caller in the process
+    global _generation_model
+    if _generation_model is None:
+        _generation_model = genai.GenerativeModel(GENERATION_MODEL)
+    return _generation_model
+
+
+def record_usage(response) -> None:
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        profiling.record_tokens(
+            prompt=getattr(usage, "prompt_token_count", None),
+            output=getattr(usage, "candidates_token_count", None)
+        )
+
+
+def generate_answer(query: str, chunks: List[Dict[str, any]], API_KEY: str, conversation_history: str = "", temperature: float = 0.1) -> Dict[str, any]:
+
+    genai.configure(api_key=API_KEY)
+    
+    # Create context from chunks
+    with profiling.span("build_prompt"):
+        context = build_context(chunks)
+        prompt = build_prompt(query, context["context"], conversation_history)
     
     # Use Gemini model for generation
-    model = genai.GenerativeModel(GENERATION_MODEL)
+    model = get_generation_model()
     
-    response = model.generate_content(
-        prompt,
-        generation_config=genai.GenerationConfig(
-            temperature=temperature,
-            max_output_tokens=1500,
-            top_p=0.9
+    with profiling.span("generate"):
+        response = get_client().call(
+            GENERATION_MODEL,
+            model.generate_content,
+            prompt,
+            generation_config=get_generation_config(temperature),
+            priority=INTERACTIVE
         )
-    )
+    record_usage(response)
 
     # Add safety check before accessing response.text
     if not response.candidates or not response.candidates[0].content.parts:
@@ -82,17 +173,81 @@ def generate_answer(query: str, chunks: List[Dict[str, any]], API_KEY: str, conv
             "chunks_used": 0
         }
     
-    # Extract page references from chunks for source citation
-    pages = []
-    for chunk in chunks:
-        page = chunk.get('metadata', {}).get('page', None)
-        if page and page not in pages:
-            pages.append(page)
-    
-    sorted_pages = sorted(pages) if pages else []
-    
     return {
         "answer": response.text,
-        "source_pages": sorted_pages,
-        "chunks_used": len(chunks)
-    }
\ No newline at end of file
+        "source_pages": get_source_pages(context["chunks"]),
+        "chunks_used": len(context["chunks"]),
+        "context_tokens": context["tokens_used"],
+        "context_tokens_saved": context["tokens_saved"]
+    }
+
+
+def generate_answer_stream(query: str, chunks: List[Dict[str, any]], API_KEY: str, conversation_history: str = "", temperature: float = 0.1) -> Iterator[Dict[str, any]]:
+    """Yield {"type": "delta", "text": ...} events as text arrives, then one {"type": "done", ...} event."""
+
+    genai.configure(api_key=API_KEY)
+    
+    start_time = time.perf_counter()
+    first_token_time = None
+    
+    with profiling.span("build_prompt"):
+        context = build_context(chunks)
+        prompt = build_prompt(query, context["context"], conversation_history)
+    
+    model = get_generation_model()
+    # The rate limiter slot is held until the stream ends, closing it early releases the slot too
+    response = get_client().stream(
+        GENERATION_MODEL,
+        model.generate_content,
+        prompt,
+        generation_config=get_generation_config(temperature),
+        stream=True,
+        priority=INTERACTIVE
+    )
+    
+    parts = []
+    last_chunk = None
+    with closing(response):
+        # Only time spent waiting on Gemini counts as generation, not the consumer's rendering
+        wait_start = time.perf_counter()
+        for response_chunk in response:
+            profiling.record("generate", time.perf_counter() - wait_start)
+            last_chunk = response_chunk
+            wait_start = time.perf_counter()
+            # Chunks without parts (e.g. safety or finish markers) have no text
+            if not response_chunk.candidates or not response_chunk.candidates[0].content.parts:
+                continue
+            text = response_chunk.text
+            if not text:
+                continue
+            if first_token_time is None:
+                first_token_time = time.perf_counter() - start_time
+            parts.append(text)
+            yield {"type": "delta", "text": text}
+            wait_start = time.perf_counter()
+    
+    total_time = time.perf_counter() - start_time
+    # The final streamed chunk carries usage for the whole response
+    record_usage(last_chunk)
+    
+    if not parts:
+        yield {
+            "type": "done",
+            "answer": "No response generated. Please try rephrasing your question.",
+            "source_pages": [],
+            "chunks_used": 0,
+            "time_to_first_token": None,
+            "total_time": total_time
+        }
+        return
+    
+    yield {
+        "type": "done",
+        "answer": "".join(parts),
+        "source_pages": get_source_pages(context["chunks"]),
+        "chunks_used": len(context["chunks"]),
+        "context_tokens": context["tokens_used"],
+        "context_tokens_saved": context["tokens_saved"],
+        "time_to_first_token": first_token_time,
+        "total_time": total_time
+    }
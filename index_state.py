@@ -0,0 +1,254 @@
+from typing import Dict, List, Optional, Tuple
+from contextlib import closing
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from config import *
+
+
+def compute_index_version(chunk_hashes: Dict[str, str], embedding_model: str = None) -> str:
+    # Version is derived from the stored content, so identical content gives identical versions
+    digest = hashlib.sha256()
+    if embedding_model:
+        # Vectors from another model retrieve differently, cached answers must not carry over
+        digest.update(f"embedding_model:{embedding_model}\n".encode("utf-8"))
+    for chunk_id in sorted(chunk_hashes):
+        digest.update(f"{chunk_id}:{chunk_hashes[chunk_id]}\n".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def write_index_version(version: str, chunk_count: int, path: str = INDEX_VERSION_FILE, embedding_model: str = None,
+                        documents: List[Dict[str, any]] = None) -> Dict[str, any]:
+    state = {
+        "index_version": version,
+        "collection": COLLECTION_NAME,
+        "chunk_count": chunk_count,
+        "embedding_model": embedding_model,
+        "documents": documents or [],  # Descriptors of the indexed PDFs, used for staleness checks and re-indexing
+        "updated_at": time.time()
+    }
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    # Write to a temp file and rename so readers never see a partial file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+    return state
+
+
+def read_index_version(path: str = INDEX_VERSION_FILE) -> Optional[Dict[str, any]]:
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _chroma_chunk_count(persist_directory: str) -> Optional[int]:
+    # Read Chroma's own SQLite catalog directly; importing chromadb alone takes over a second
+    db_path = os.path.join(persist_directory, "chroma.sqlite3")
+    if not os.path.exists(db_path):
+        return None
+    try:
+        with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+            if conn.execute("SELECT 1 FROM collections WHERE name = ?", (COLLECTION_NAME,)).fetchone() is None:
+                return None
+            row = conn.execute(
+                "SELECT COUNT(*) FROM embeddings e "
+                "JOIN segments s ON e.segment_id = s.id "
+                "JOIN collections c ON s.collection = c.id "
+                "WHERE c.name = ?",
+                (COLLECTION_NAME,)
+            ).fetchone()
+            return row[0]
+    except sqlite3.Error:
+        # Unknown catalog layout, trust the version file's count
+        return -1
+
+
+def _numpy_chunk_count(directory: str) -> Optional[int]:
+    db_path = os.path.join(directory, "records.sqlite3")
+    if not os.path.exists(db_path):
+        # Stores from before the SQLite sidecar, migrated when the store is opened
+        return _legacy_numpy_chunk_count(directory)
+    try:
+        with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+            return conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+    except sqlite3.Error:
+        return None
+
+
+def _legacy_numpy_chunk_count(directory: str) -> Optional[int]:
+    meta_path = os.path.join(directory, "metadata.json")
+    if not os.path.exists(os.path.join(directory, "embeddings.npy")) or not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return len(json.load(f)["ids"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def embedding_model_matches(state: Optional[Dict[str, any]], provider: str = EMBEDDING_PROVIDER) -> bool:
+    """Whether an index version was embedded by the configured provider, without loading the model."""
+    if not state:
+        return True
+    recorded = state.get("embedding_model") or f"gemini:{EMBEDDING_MODEL}"
+    if provider == "local":
+        # The full local model id carries a fingerprint of the fit, checked when the retriever loads it
+        return recorded.startswith("local:") and os.path.exists(LOCAL_EMBEDDING_MODEL_FILE)
+    return recorded == f"{provider}:{EMBEDDING_MODEL}"
+
+
+def check_index(backend: str = VECTOR_STORE_BACKEND, path: str = INDEX_VERSION_FILE) -> Tuple[bool, str]:
+    """Cheap readiness check run before the heavy modules load; returns (ready, reason).
+
+    Sources are the documents recorded by the last indexing run, whatever corpus that was.
+    """
+    state = read_index_version(path)
+    if state is None:
+        return False, "no index found"
+    if state.get("collection") != COLLECTION_NAME:
+        return False, f"index was built for collection '{state.get('collection')}'"
+    if not state.get("chunk_count"):
+        return False, "index is empty"
+    if not embedding_model_matches(state):
+        return False, f"index was embedded with '{state.get('embedding_model') or f'gemini:{EMBEDDING_MODEL}'}' but the {EMBEDDING_PROVIDER} provider is configured"
+
+    if backend == "chroma":
+        stored_count = _chroma_chunk_count(CHROMA_DB_PATH)
+    elif backend == "numpy":
+        stored_count = _numpy_chunk_count(NUMPY_STORE_DIR)
+    else:
+        return False, f"unknown vector store backend '{backend}'"
+    if stored_count is None:
+        return False, f"no '{COLLECTION_NAME}' collection in the {backend} store"
+    if stored_count >= 0 and stored_count != state["chunk_count"]:
+        return False, f"store holds {stored_count} chunks but index version {state['index_version']} has {state['chunk_count']}"
+
+    # A source edited after the last indexing run needs an incremental update, a removed one is just no longer checked
+    for document in state.get("documents", []):
+        source_path = document.get("path")
+        if source_path and os.path.exists(source_path) and os.path.getmtime(source_path) > state.get("updated_at", 0):
+            return False, f"{source_path} changed since the last indexing run"
+
+    return True, f"index version {state['index_version']}, {state['chunk_count']} chunks"
+
+
+_state_memo = {}  # path -> (mtime, state)
+
+
+def current_index_state(path: str = INDEX_VERSION_FILE) -> Dict[str, any]:
+    # Re-read the version file only when an indexing run has rewritten it
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    memo = _state_memo.get(path)
+    if memo is None or memo[0] != mtime:
+        memo = _state_memo[path] = (mtime, read_index_version(path) or {})
+    return memo[1]
+
+
+def current_index_version(path: str = INDEX_VERSION_FILE) -> Optional[str]:
+    return current_index_state(path).get("index_version")
+
+
+class PageCheckpoints:
+    """Per-page extraction records, written as indexing progresses so an interrupted run can resume."""
+
+    EXTRACTED = "extracted"  # Text is final, chunks not yet confirmed in the vector store
+    EMBEDDED = "embedded"  # Chunks are embedded and upserted
+
+    def __init__(self, db_path: str = CHECKPOINT_FILE):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Extraction writes from the prefetch thread, embedding status from the main thread
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                source TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                source_hash TEXT NOT NULL,
+                method TEXT NOT NULL,
+                text TEXT NOT NULL,
+                chunk_ids TEXT NOT NULL,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (source, page)
+            )"""
+        )
+        self._conn.commit()
+
+    def get_many(self, source: str, page_hashes: Dict[int, str]) -> Dict[int, Dict[str, any]]:
+        """Checkpoints for the given pages whose source hash still matches; failed extractions are left out."""
+        if not page_hashes:
+            return {}
+        pages = list(page_hashes)
+        placeholders = ",".join("?" * len(pages))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT page, source_hash, method, text, chunk_ids, status FROM pages WHERE source = ? AND page IN ({placeholders})",
+                [source] + pages
+            ).fetchall()
+        found = {}
+        for page, source_hash, method, text, chunk_ids, status in rows:
+            # A page whose vision call failed is extracted again, e.g. after quota exhaustion
+            if source_hash != page_hashes[page] or method == "vision_failed":
+                continue
+            found[page] = {"method": method, "text": text, "chunk_ids": json.loads(chunk_ids), "status": status}
+        return found
+
+    def save_many(self, source: str, pages: List[Dict[str, any]]):
+        # pages: [{"page_number", "source_hash", "method", "text"}]
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO pages (source, page, source_hash, method, text, chunk_ids, status, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, '[]', ?, ?)",
+                [(source, page["page_number"], page["source_hash"], page["method"], page["text"], self.EXTRACTED, now) for page in pages]
+            )
+            self._conn.commit()
+
+    def mark_embedded(self, source: str, chunk_ids: Dict[int, List[str]]):
+        """Record the chunks of each page once they are in the vector store."""
+        if not chunk_ids:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE pages SET chunk_ids = ?, status = ?, updated_at = ? WHERE source = ? AND page = ?",
+                [(json.dumps(ids), self.EMBEDDED, now, source, page) for page, ids in chunk_ids.items()]
+            )
+            self._conn.commit()
+
+    def reset_status(self):
+        # After a rebuild the extracted text is still valid, but nothing is in the store yet
+        with self._lock:
+            self._conn.execute("UPDATE pages SET status = ?", (self.EXTRACTED,))
+            self._conn.commit()
+
+    def prune(self, source: str, page_count: int):
+        # Drop pages beyond the end of a document that got shorter
+        with self._lock:
+            self._conn.execute("DELETE FROM pages WHERE source = ? AND page > ?", (source, page_count))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,13 +1,25 @@
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator, Optional
 import pymupdf4llm
-import chromadb
 import google.generativeai as genai
 from utils import chunk_documents
+from cache import EmbeddingCache, TableCache, text_hash
+from bm25 import BM25Index
+from tables import TableStore, parse_table_blocks
+from vector_store import VectorStore, open_vector_store
+import profiling
+from gemini_client import get_client, BACKGROUND
+from index_state import PageCheckpoints, compute_index_version, read_index_version, write_index_version
+from embeddings import EmbeddingProvider, get_embedding_provider, check_embedding_model
+import hashlib
+import json
 import os
 import re
 import fitz  # PyMuPDF
-import io
-from PIL import Image
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import *
 
 
@@ -25,25 +37,7 @@ def has_table(page_text: str) -> bool:
     return False
 
 
-def extract_table_with_gemini(pdf_path: str, page_num: int, API_KEY: str) -> str:
-
-    genai.configure(api_key=API_KEY)
-    
-    # Open PDF and extract page as image
-    doc = fitz.open(pdf_path)
-    page = doc[page_num - 1]  # 0 based indexing
-    
-    # Convert page to image
-    mat = fitz.Matrix(2.0, 2.0)  # 2x zoom for better quality
-    pix = page.get_pixmap(matrix=mat)
-    img_data = pix.tobytes("png")
-    
-    # Create PIL Image
-    image = Image.open(io.BytesIO(img_data))
-    
-    doc.close()
-    
-    prompt = """
+TABLE_EXTRACTION_PROMPT = """
     Convert this PDF page content to well-formatted markdown. Pay special attention to:
 
     1. Extract all tables with proper markdown table formatting.
@@ -66,160 +60,729 @@ def extract_table_with_gemini(pdf_path: str, page_num: int, API_KEY: str) -> str
     - Do not shorten or modify the summary or other text.  
     """
 
+
+TABLE_REGION_PROMPT = """
+    Each image is one table cropped from a PDF page, in reading order. Transcribe every image as a markdown table.
+
+    1. Preserve all numerical data accurately.
+    2. Include the table title (e.g. "Table 1.2.3 ...") and headers if visible.
+    3. After each table, provide a detailed summary of what the table contains (e.g., "Summary of Table 1.2.3: ...").
+
+    IMPORTANT:  
+    Output one block per image, in the same order, and nothing else:  
+    ---TABLE_START---  
+    ### Table Title  
+    [table with unnecessary whitespace and indentation removed, concise and properly aligned]  
+    ---TABLE_END---  
+    [summary text]
+    """
+
+
+def find_table_regions(page: fitz.Page, page_boxes: List[Dict[str, any]] = None) -> List[Dict[str, any]]:
+    """Table areas of a page as {"rect", "span"}, span being the table's character range in the extracted text if known."""
+    if page_boxes is not None:
+        # Reuse pymupdf4llm's layout analysis rather than detecting tables a second time
+        found = []
+        for i, box in enumerate(page_boxes):
+            if box["class"] != "table":
+                continue
+            rect = fitz.Rect(box["bbox"])
+            start, end = box["pos"]
+            previous = page_boxes[i - 1] if i else None
+            if previous and previous["class"] == "caption":
+                rect |= fitz.Rect(previous["bbox"])
+                start = previous["pos"][0]
+            elif previous and previous["class"] == "text" and fitz.Rect(previous["bbox"]).y0 >= rect.y0 - TABLE_CAPTION_MARGIN:
+                # A caption laid out as plain text still falls inside the crop
+                start = previous["pos"][0]
+            # The transcription repeats the caption as its title, so the caption's text is replaced too
+            found.append((rect, (start, end)))
+    else:
+        try:
+            found = [(fitz.Rect(table.bbox), None) for table in page.find_tables().tables]
+        except Exception:
+            return []
+    
+    regions = []
+    for rect, span in sorted(found, key=lambda item: (item[0].y0, item[0].x0)):
+        # Widen the box a little, and upwards to take in a "Table X.X.X" caption
+        rect = fitz.Rect(rect.x0 - TABLE_REGION_PADDING, rect.y0 - TABLE_CAPTION_MARGIN,
+                         rect.x1 + TABLE_REGION_PADDING, rect.y1 + TABLE_REGION_PADDING) & page.rect
+        if regions and regions[-1]["rect"].intersects(rect):
+            previous = regions[-1]
+            previous["rect"] |= rect
+            if previous["span"] and span:
+                previous["span"] = (min(previous["span"][0], span[0]), max(previous["span"][1], span[1]))
+            else:
+                previous["span"] = None
+        else:
+            regions.append({"rect": rect, "span": span})
+    return regions
+
+
+def choose_zoom(page: fitz.Page, clip: fitz.Rect) -> float:
+    # Small, dense type needs more pixels per point to stay legible; large type needs fewer
+    sizes = sorted(
+        span["size"]
+        for block in page.get_text("dict", clip=clip)["blocks"]
+        for line in block.get("lines", [])
+        for span in line["spans"] if span["text"].strip()
+    )
+    zoom = TABLE_TARGET_GLYPH_PX / sizes[len(sizes) // 2] if sizes else TABLE_MAX_ZOOM
+    zoom = min(max(zoom, TABLE_MIN_ZOOM), TABLE_MAX_ZOOM)
+    
+    # Cap the pixel count of very large regions
+    max_zoom = (TABLE_MAX_PIXELS / max(clip.width * clip.height, 1.0)) ** 0.5
+    return min(zoom, max_zoom)
+
+
+def render_table_images(doc: fitz.Document, page_num: int, page_boxes: List[Dict[str, any]] = None) -> Dict[str, any]:
+    """Render the table regions of a page, or the whole page when none are found."""
+    page = doc[page_num - 1]  # 0 based indexing
+    
+    regions = find_table_regions(page, page_boxes)
+    images, zooms = [], []
+    for clip in [region["rect"] for region in regions] or [page.rect]:
+        zoom = choose_zoom(page, clip)
+        # Grayscale keeps the PNG small, table text has no meaningful color
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, colorspace=fitz.csGRAY)
+        images.append(pix.tobytes("png"))
+        zooms.append(zoom)
+    
+    return {
+        "images": images,
+        "cropped": bool(regions),
+        "spans": [region["span"] for region in regions],
+        "zoom": max(zooms)
+    }
+
+
+def extract_table_with_gemini(images: List[bytes], page_num: int, cropped: bool = False) -> str:
+    # genai must already be configured by the caller
+    prompt = TABLE_REGION_PROMPT if cropped else TABLE_EXTRACTION_PROMPT
+    # PNG bytes go straight into the request, no decode and re-encode through PIL
+    contents = [prompt] + [{"mime_type": "image/png", "data": image} for image in images]
     
     try:
         model = genai.GenerativeModel(TABLE_EXTRACTION_MODEL)
-        response = model.generate_content([prompt, image])
+        response = get_client().call(TABLE_EXTRACTION_MODEL, model.generate_content, contents, priority=BACKGROUND)
         return response.text
     except Exception as e:
         print(f"Error processing page {page_num} with Gemini: {e}")
         return None
 
 
-def extract_text_from_pdf(pdf_path: str, API_KEY: str = None) -> List[Dict[str, any]]:
-    # Extract markdown content from PDF
-    markdown_content = pymupdf4llm.to_markdown(pdf_path, page_chunks=True)
-
-    # Convert to better structure
-    documents = []
-    for page_num, page_dict in enumerate(markdown_content, 1):
-        page_text = page_dict.get('text', '')
-        
-        # Check if page has tables
-        if has_table(page_text):
-            print(f"Page {page_num} contains tables, processing with Gemini...")
-            enhanced_text = extract_table_with_gemini(pdf_path, page_num, API_KEY)
-            if enhanced_text:
-                page_text = enhanced_text
-                print(f"Successfully enhanced page {page_num} with Gemini")
-            else:
-                print(f"Failed to enhance page {page_num}, using original text")
-        
-        documents.append({
-            "page_number": page_num,
-            "text": page_text,
-            "source_type": "page"
-        })
+def merge_table_blocks(page_text: str, vision_text: str, spans: List[Tuple[int, int]] = None) -> str:
+    """Put transcribed tables in place of the page's extracted markdown tables, keeping the other text."""
+    blocks = ["---TABLE_START---" + part.rstrip() for part in vision_text.split("---TABLE_START---")[1:]]
+    if not blocks:
+        return page_text
     
-    return documents
+    if spans and all(spans):
+        # Replace from the end so earlier character offsets stay valid
+        merged = page_text
+        for (start, end), block in reversed(list(zip(spans, blocks))):
+            merged = merged[:start] + block + "\n\n" + merged[end:]
+        extra = blocks[len(spans):]
+    else:
+        # No offsets: each run of pipe lines is one table, swapped for the next transcription
+        lines = []
+        remaining = iter(blocks)
+        in_table = keep_original = False
+        for line in page_text.split("\n"):
+            if not line.lstrip().startswith("|"):
+                in_table = False
+                lines.append(line)
+                continue
+            if not in_table:
+                in_table = True
+                block = next(remaining, None)
+                keep_original = block is None
+                if block is not None:
+                    lines.append(block)
+            if keep_original:
+                lines.append(line)
+        merged = "\n".join(lines)
+        extra = list(remaining)
+    
+    # Tables the text extractor missed go at the end of the page
+    return "\n\n".join([merged.rstrip()] + extra) if extra else merged
 
 
-def get_embeddings(texts: List[str], API_KEY: str) -> List[List[float]]:
+def extract_tables_parallel(doc: fitz.Document, page_nums: List[int], API_KEY: str, cache: TableCache = None, max_workers: int = TABLE_EXTRACTION_MAX_WORKERS,
+                            page_texts: Dict[int, str] = None, page_boxes: Dict[int, List[Dict[str, any]]] = None) -> Dict[int, str]:
+    """Return the enhanced text of each table page; cropped tables are merged into page_texts when given."""
+    if not page_nums:
+        return {}
+    
+    if cache is None:
+        cache = TableCache()
+    page_texts = page_texts or {}
+    page_boxes = page_boxes or {}
+    
     genai.configure(api_key=API_KEY)
     
-    embeddings = []
-    model = EMBEDDING_MODEL
+    # Render on the caller's document handle, before the worker pool starts (fitz is not thread-safe)
+    with profiling.span("table_render"):
+        rendered = {page_num: render_table_images(doc, page_num, page_boxes.get(page_num)) for page_num in page_nums}
     
-    # Process in batches to avoid rate limits
-    batch_size = EMBEDDING_BATCH_SIZE
-    for i in range(0, len(texts), batch_size):
-        batch_texts = texts[i:i + batch_size]
-        
-        # Embed each text in the batch
-        for text in batch_texts:
-            result = genai.embed_content(
-                model=model,
-                content=text,
-                task_type="retrieval_document"
-            )
-            embeddings.append(result['embedding'])
+    def finish(page_num: int, vision_text: str) -> str:
+        # Cropped tables replace only the table parts of the extracted page text
+        if vision_text and rendered[page_num]["cropped"] and page_texts.get(page_num):
+            return merge_table_blocks(page_texts[page_num], vision_text, rendered[page_num]["spans"])
+        return vision_text
+    
+    results = {}
+    pending = {}
+    for page_num, render in rendered.items():
+        key = cache.key(b"".join(render["images"]))
+        cached_text = cache.get(key)
+        if cached_text is not None:
+            results[page_num] = finish(page_num, cached_text)
+        else:
+            pending[page_num] = key
+    
+    print(f"Table pages: {len(results)} cached, {len(pending)} to process with Gemini")
+    
+    def timed_extract(page_num: int) -> Tuple[str, float]:
+        render = rendered[page_num]
+        start = time.perf_counter()
+        text = extract_table_with_gemini(render["images"], page_num, render["cropped"])
+        return text, time.perf_counter() - start
+    
+    # Only the vision calls run in the worker pool
+    uploaded_bytes = 0
+    vision_seconds = 0.0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(timed_extract, page_num): page_num for page_num in pending}
+        for future in as_completed(futures):
+            page_num = futures[future]
+            vision_text, latency = future.result()
+            render = rendered[page_num]
+            page_bytes = sum(len(image) for image in render["images"])
+            uploaded_bytes += page_bytes
+            vision_seconds += latency
+            profiling.record("vision_call", latency)
+            
+            results[page_num] = finish(page_num, vision_text)
+            if vision_text:
+                cache.put(pending[page_num], vision_text)
+                regions = len(render["images"])
+                scope = f"{regions} table region{'s' if regions != 1 else ''}" if render["cropped"] else "full page"
+                print(f"Successfully enhanced page {page_num} with Gemini ({scope}, {page_bytes / 1024:.0f} KB at {render['zoom']:.1f}x, vision {latency:.2f}s)")
+    
+    if pending:
+        print(f"Vision upload: {uploaded_bytes / 1024:.0f} KB for {len(pending)} pages, {vision_seconds:.2f}s total vision latency")
+    
+    return results
 
-    return embeddings
 
+def page_hash(page: fitz.Page) -> str:
+    """Hash of what extraction sees on a page (content stream, images, size) plus the vision model."""
+    digest = hashlib.sha256(f"{TABLE_EXTRACTION_MODEL}|{pymupdf4llm.__version__}|{tuple(page.rect)}".encode("utf-8"))
+    digest.update(page.read_contents())
+    for image in page.get_images(full=True):
+        # xref and size stand in for the image bytes, reading every image would defeat the checkpoint
+        digest.update(f"|{image[0]}:{image[2]}x{image[3]}".encode("utf-8"))
+    return digest.hexdigest()
 
-def create_vector_store(persist_directory: str = CHROMA_DB_PATH) -> chromadb.Collection:
 
-    client = chromadb.PersistentClient(path=persist_directory)
+def iter_pdf_pages(pdf_path: str, API_KEY: str = None, window_size: int = PAGE_WINDOW_SIZE, checkpoints: PageCheckpoints = None) -> Iterator[Dict[str, any]]:
+    """Yield extracted pages one at a time, holding at most one window of pages in memory.
+
+    With checkpoints, pages extracted by an earlier run are read back instead of extracted again,
+    and every newly extracted page is checkpointed before it is yielded.
+    """
+    source = os.path.abspath(pdf_path)
+    doc = fitz.open(pdf_path)
+    try:
+        page_count = doc.page_count
+        if checkpoints is not None:
+            checkpoints.prune(source, page_count)
+        for window_start in range(0, page_count, window_size):
+            page_indices = list(range(window_start, min(window_start + window_size, page_count)))
+            
+            saved = {}
+            hashes = {}
+            if checkpoints is not None:
+                with profiling.span("checkpoint"):
+                    hashes = {page_idx + 1: page_hash(doc[page_idx]) for page_idx in page_indices}
+                    saved = checkpoints.get_many(source, hashes)
+            missing = [page_idx for page_idx in page_indices if page_idx + 1 not in saved]
+            
+            # Extract markdown content for the pages of this window that have no checkpoint
+            page_texts = {}
+            page_boxes = {}
+            table_pages = []
+            if missing:
+                with profiling.span("extract"):
+                    markdown_content = pymupdf4llm.to_markdown(doc, pages=missing, page_chunks=True)
+                for page_idx, page_dict in zip(missing, markdown_content):
+                    page_num = page_idx + 1
+                    page_texts[page_num] = page_dict.get('text', '')
+                    page_boxes[page_num] = page_dict.get('page_boxes')
+                    if has_table(page_texts[page_num]):
+                        table_pages.append(page_num)
+            
+            # Table pages within the window are sent to Gemini together
+            if table_pages:
+                print(f"Pages {', '.join(map(str, table_pages))} contain tables, processing with Gemini...")
+            with profiling.span("table_vision"):
+                enhanced_pages = extract_tables_parallel(doc, table_pages, API_KEY, page_texts=page_texts, page_boxes=page_boxes)
+            
+            extracted = []
+            for page_num, page_text in page_texts.items():
+                method = "text"
+                if page_num in enhanced_pages:
+                    if enhanced_pages[page_num]:
+                        page_text = enhanced_pages[page_num]
+                        method = "vision"
+                    else:
+                        print(f"Failed to enhance page {page_num}, using original text")
+                        method = "vision_failed"
+                extracted.append({"page_number": page_num, "source_hash": hashes.get(page_num, ""), "method": method, "text": page_text})
+            
+            if checkpoints is not None and extracted:
+                with profiling.span("checkpoint"):
+                    checkpoints.save_many(source, extracted)
+            
+            pages = {page["page_number"]: (page["text"], False) for page in extracted}
+            pages.update((page_num, (checkpoint["text"], True)) for page_num, checkpoint in saved.items())
+            for page_num in sorted(pages):
+                page_text, resumed = pages[page_num]
+                yield {
+                    "page_number": page_num,
+                    "text": page_text,
+                    "source_type": "page",
+                    "page_count": page_count,
+                    "resumed": resumed
+                }
+    finally:
+        doc.close()
+
+
+def extract_text_from_pdf(pdf_path: str, API_KEY: str = None) -> List[Dict[str, any]]:
+    documents = []
+    for page in iter_pdf_pages(pdf_path, API_KEY):
+        page.pop("page_count", None)
+        page.pop("resumed", None)
+        documents.append(page)
+    return documents
+
+
+def prefetch(iterator: Iterator, max_buffered: int = PIPELINE_QUEUE_SIZE) -> Iterator:
+    """Run an iterator in a background thread, blocking it once max_buffered items are waiting."""
+    items = queue.Queue(maxsize=max_buffered)
+    done = object()
+    stop = threading.Event()
     
-    # Delete existing collection if it exists (for clean indexing)
-    collection_path = os.path.join(persist_directory, "chroma.sqlite3")
-    if os.path.exists(collection_path):
-        existing_collections = []
-        for col in client.list_collections():
-            existing_collections.append(col.name)
-        if COLLECTION_NAME in existing_collections:
-            client.delete_collection(name=COLLECTION_NAME)
+    def put(item) -> bool:
+        # Gives up once the consumer has stopped, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
     
-    collection = client.create_collection(
-        name=COLLECTION_NAME,
-        metadata={"hnsw:space": "cosine"}
-    )
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    break
+            else:
+                put(done)
+        except BaseException as e:
+            put(e)
+        finally:
+            # A generator has to be closed by the thread running it, this also closes its PDF
+            if hasattr(iterator, "close"):
+                iterator.close()
     
-    return collection
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Also runs when the consumer fails or stops early; the producer finishes its current item and exits
+        stop.set()
+        producer.join()
 
 
-def index_pdf(pdf_path: str, API_KEY: str, chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP) -> Tuple[str, int]:
+def get_embeddings(texts: List[str], API_KEY: str) -> List[List[float]]:
+    return get_embedding_provider(API_KEY).embed_documents(texts)
 
-    print("Extracting text from PDF...")
-    documents = extract_text_from_pdf(pdf_path, API_KEY)
-    
-    if not documents:
-        print("No content extracted from PDF!")
-        return COLLECTION_NAME, 0
+
+def get_embeddings_cached(texts: List[str], API_KEY: str, cache: EmbeddingCache = None) -> List[List[float]]:
+    provider = get_embedding_provider(API_KEY)
+    if not provider.cache_embeddings:
+        # Local embeddings cost less to recompute than to look up
+        return provider.embed_documents(texts)
+
+    # Look up every text in the cache first, only embed the misses
+    if cache is None:
+        cache = EmbeddingCache()
+
+    embeddings = cache.get_many(texts, model=provider.model_name)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+    print(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+
+    if missing:
+        new_texts = [texts[i] for i in missing]
+        new_embeddings = provider.embed_documents(new_texts)
+        cache.put_many(new_texts, new_embeddings, model=provider.model_name)
+        for i, embedding in zip(missing, new_embeddings):
+            embeddings[i] = embedding
+
+    return embeddings
+
+
+HEADER_PATTERN = re.compile(r'^#{1,3}\s+(.+?)\s*$', re.MULTILINE)
+TABLE_BLOCK = re.compile(r'---TABLE_START---.*?(?:---TABLE_END---|\Z)', re.DOTALL)
+
+
+def section_text(text: str) -> str:
+    """Chunk text without vision table blocks, whose "### Table ..." titles are not document sections."""
+    # A chunk can start inside a block that began in the previous chunk
+    start, end = text.find("---TABLE_START---"), text.find("---TABLE_END---")
+    if end != -1 and (start == -1 or end < start):
+        text = text[end + len("---TABLE_END---"):]
+    return TABLE_BLOCK.sub("", text)
+
+
+def discover_documents(source: str) -> List[Dict[str, any]]:
+    """Resolve a PDF path, a directory of PDFs, or a JSON manifest into document descriptors."""
+    if source.lower().endswith(".json"):
+        # Manifest: [{"path": "...", "doc_id": "...", "year": 2024, "department": "..."}]
+        with open(source, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        base_dir = os.path.dirname(source)
+        documents = []
+        for entry in entries:
+            path = entry["path"] if os.path.isabs(entry["path"]) else os.path.join(base_dir, entry["path"])
+            document = describe_document(path)
+            document.update({key: value for key, value in entry.items() if key != "path"})
+            documents.append(document)
+        return documents
     
-    print(f"Extracted {len(documents)} pages from PDF")
+    if os.path.isdir(source):
+        return [
+            describe_document(os.path.join(source, name))
+            for name in sorted(os.listdir(source)) if name.lower().endswith(".pdf")
+        ]
     
-    # Save extracted content for reference (optional)
-    with open(EXTRACTED_CONTENT_FILE, "w", encoding="utf-8") as f:
-        for content in documents:
-            f.write(f"=== Page {content['page_number']} ===\n")
-            f.write(f"Text:\n\n{content['text']}\n")
-            f.write("\n" + "="*50 + "\n\n")
+    return [describe_document(source)]
+
+
+def describe_document(pdf_path: str) -> Dict[str, any]:
+    doc_id = os.path.splitext(os.path.basename(pdf_path))[0]
+    document = {"path": pdf_path, "doc_id": doc_id}
+    # Pick up a year from names like Budget_2024.pdf
+    year = re.search(r'(?<!\d)(19|20)\d{2}(?!\d)', doc_id)
+    if year:
+        document["year"] = int(year.group(0))
+    return document
+
 
-    # Filter out empty pages for chunking (but keep page numbers in metadata)
-    non_empty_documents = [doc for doc in documents if doc['text'].strip()]
-    print(f"Found {len(non_empty_documents)} non-empty pages to chunk")
+def prepare_page_chunks(page: Dict[str, any], chunk_size: int, chunk_overlap: int, document: Dict[str, any] = None, section: str = None) -> Tuple[List[Dict[str, any]], str]:
+    page = {key: value for key, value in page.items() if key != "page_count"}
+    chunks = chunk_documents([page], chunk_size, chunk_overlap)
     
-    # Chunk the documents
-    print(f"Chunking documents with chunk_size={chunk_size}, overlap={chunk_overlap}...")
-    chunks_to_index = chunk_documents(non_empty_documents, chunk_size, chunk_overlap)
+    # Single-document indexes keep the original id scheme
+    id_prefix = f"{document['doc_id']}_" if document else ""
+    document_metadata = {key: value for key, value in (document or {}).items() if key != "path"}
     
     # Prepare for indexing
-    for i, chunk in enumerate(chunks_to_index):
+    for i, chunk in enumerate(chunks):
         page_num = chunk.get("page_number", "unknown")
         source_type = chunk.get("source_type", "text")
         chunk_idx = chunk.get("chunk_index", i)
         
-        chunk["id"] = f"page_{page_num}_chunk_{chunk_idx}"
+        # Section is the header in effect where the chunk starts
+        text = section_text(chunk["text"])
+        headers = HEADER_PATTERN.findall(text)
+        if headers and HEADER_PATTERN.match(text.lstrip()):
+            section = headers[0]
+        chunk_section = section
+        if headers:
+            section = headers[-1]
+        
+        chunk["id"] = f"{id_prefix}page_{page_num}_chunk_{chunk_idx}"
         chunk["metadata"] = {
             "page": page_num,
             "source_type": source_type,
             "chunk_index": chunk_idx,
-            "total_chunks": chunk.get("total_chunks", 1)
+            "total_chunks": chunk.get("total_chunks", 1),
+            "content_hash": text_hash(chunk["text"]),
+            **document_metadata
         }
+        # Chroma metadata values cannot be None
+        if chunk_section:
+            chunk["metadata"]["section"] = chunk_section[:200]
+    
+    return chunks, section
+
+
+def index_document(store: VectorStore, pdf_path: str, API_KEY: str, stored_hashes: Dict[str, str], records: Dict[str, list], document: Dict[str, any] = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP, batch_size: int = INDEX_PIPELINE_BATCH_SIZE, extracted_file = None,
+                   checkpoints: PageCheckpoints = None) -> int:
+    """Extract, chunk, embed and upsert one PDF page by page, recording chunk ids and hashes only. Returns the page count."""
+    
+    pending = []
+    page_total = 0
+    unchanged = 0
+    resumed = 0
+    section = None
+    start_time = time.perf_counter()
+    source = os.path.abspath(pdf_path)
+    # Pages whose chunks are all either in the store or pending, by page number
+    page_chunk_ids = {}
+    
+    def flush():
+        if pending:
+            texts = [chunk["text"] for chunk in pending]
+            with profiling.span("embed"):
+                embeddings = get_embeddings_cached(texts, API_KEY)
+            with profiling.span("upsert"):
+                store.upsert(
+                    ids=[chunk["id"] for chunk in pending],
+                    embeddings=embeddings,
+                    documents=texts,
+                    metadatas=[chunk["metadata"] for chunk in pending]
+                )
+            pending.clear()
+        # Only now are these pages safely in the store
+        if checkpoints is not None:
+            checkpoints.mark_embedded(source, page_chunk_ids)
+        page_chunk_ids.clear()
+    
+    print(f"Indexing {pdf_path} with chunk_size={chunk_size}, overlap={chunk_overlap}...")
+    
+    # Extraction runs ahead in a background thread, bounded by the queue size
+    for page in prefetch(iter_pdf_pages(pdf_path, API_KEY, checkpoints=checkpoints)):
+        page_total += 1
+        resumed += page["resumed"]
+        if extracted_file is not None:
+            extracted_file.write(f"=== Page {page['page_number']} ===\n")
+            extracted_file.write(f"Text:\n\n{page['text']}\n")
+            extracted_file.write("\n" + "="*50 + "\n\n")
+        
+        # Empty pages produce no chunks (but keep page numbers in metadata)
+        if not page['text'].strip():
+            page_chunk_ids[page['page_number']] = []
+            continue
+        
+        with profiling.span("chunk"):
+            chunks, section = prepare_page_chunks(page, chunk_size, chunk_overlap, document, section)
+            # Vision-extracted tables also go to the structured table store, whole rather than chunked
+            for table in parse_table_blocks(page['text']):
+                table["page"] = page['page_number']
+                table["metadata"] = {key: value for key, value in (document or {}).items() if key != "path"}
+                records["tables"].append(table)
+        for chunk in chunks:
+            # Texts go to the store and are read back for BM25, so memory stays flat for large filings
+            records["hashes"][chunk["id"]] = chunk["metadata"]["content_hash"]
+            
+            if stored_hashes.get(chunk["id"]) == chunk["metadata"]["content_hash"]:
+                unchanged += 1
+            else:
+                pending.append(chunk)
+        page_chunk_ids[page['page_number']] = [chunk["id"] for chunk in chunks]
+        
+        if len(pending) >= batch_size:
+            flush()
+        
+        elapsed = time.perf_counter() - start_time
+        print(f"Progress: page {page['page_number']}/{page['page_count']}, {len(records['hashes'])} chunks ({unchanged} unchanged), {page_total / elapsed:.2f} pages/sec")
+    
+    flush()
+    if resumed:
+        print(f"Resumed {resumed}/{page_total} pages from checkpoints")
+    return page_total
+
+
+def iter_chunk_texts(sources: List[Tuple[str, Dict[str, any]]], API_KEY: str, chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+                     checkpoints: PageCheckpoints = None) -> Iterator[str]:
+    """Chunk texts exactly as indexing will produce them, for each (pdf_path, document) pair."""
+    for pdf_path, document in sources:
+        section = None
+        for page in iter_pdf_pages(pdf_path, API_KEY, checkpoints=checkpoints):
+            if page['text'].strip():
+                chunks, section = prepare_page_chunks(page, chunk_size, chunk_overlap, document, section)
+                yield from (chunk["text"] for chunk in chunks)
+
+
+def prepare_embedding_provider(store: VectorStore, sources: List[Tuple[str, Dict[str, any]]], API_KEY: str, incremental: bool = True,
+                               chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP, checkpoints: PageCheckpoints = None) -> EmbeddingProvider:
+    provider = get_embedding_provider(API_KEY)
+    if incremental and store.count():
+        # New chunks must land next to vectors from the same model
+        check_embedding_model(store.get_embedding_model(), provider)
+    elif provider.trainable:
+        # A new or rebuilt index refits the model on its own corpus. The extra pass reads pages back
+        # from the checkpoints it writes, so the indexing pass after it does not extract them again
+        print(f"Fitting {provider.name} embedding model...")
+        with profiling.span("embedding_fit"):
+            provider.fit(list(iter_chunk_texts(sources, API_KEY, chunk_size, chunk_overlap, checkpoints)))
+    return provider
+
+
+def document_key(document: Dict[str, any]) -> str:
+    # Corpus documents are keyed by doc_id, a PDF indexed on its own has none
+    return document.get("doc_id")
+
+
+def owned_chunk_pattern(documents: List[Dict[str, any]]) -> re.Pattern:
+    """Chunk ids produced by indexing these documents ("<doc_id>_page_N_chunk_M", or "page_N_chunk_M" without a doc_id)."""
+    prefixes = sorted({re.escape(f"{document_key(document)}_") if document_key(document) else "" for document in documents})
+    return re.compile(rf"^(?:{'|'.join(prefixes)})page_\d+_chunk_\d+$")
+
+
+def finalize_index(store: VectorStore, stored_hashes: Dict[str, str], records: Dict[str, list], embedding_model: str = None,
+                   documents: List[Dict[str, any]] = None) -> Dict[str, any]:
+    """Delete stale chunks of the indexed documents, rebuild BM25 and tables over the whole store, and stamp the version."""
+    # Only the documents indexed in this run can have stale chunks, other documents are kept as they are
+    owned = owned_chunk_pattern(documents) if documents is not None else None
+    seen_ids = records["hashes"]
+    stale_ids = [chunk_id for chunk_id in stored_hashes if chunk_id not in seen_ids and (owned is None or owned.match(chunk_id))]
+    if stale_ids:
+        print(f"Removing {len(stale_ids)} stale chunks")
+        with profiling.span("delete_stale"):
+            store.delete(stale_ids)
+    with profiling.span("store_commit"):
+        store.commit()
+    
+    kept_ids = [chunk_id for chunk_id in stored_hashes if chunk_id not in seen_ids and not (owned is None or owned.match(chunk_id))]
+    chunk_hashes = dict(records["hashes"])
+    chunk_hashes.update((chunk_id, stored_hashes[chunk_id]) for chunk_id in kept_ids)
+    if kept_ids:
+        print(f"Keeping {len(kept_ids)} chunks of documents not indexed in this run")
+    
+    def stored_chunks() -> Iterator[Tuple[str, str, Dict[str, any]]]:
+        # Texts are read back from the store a batch at a time, never held for the whole corpus
+        ids = list(chunk_hashes)
+        for start in range(0, len(ids), INDEX_WRITE_BATCH_SIZE):
+            batch = ids[start:start + INDEX_WRITE_BATCH_SIZE]
+            documents = store.get_documents(batch)
+            for chunk_id in batch:
+                if chunk_id in documents:
+                    text, metadata = documents[chunk_id]
+                    yield chunk_id, text, metadata
     
-    if not chunks_to_index:
+    # Rebuild the lexical index over the full chunk set
+    print("Building BM25 index...")
+    with profiling.span("bm25_build"):
+        bm25 = BM25Index.build(stored_chunks())
+        bm25.save()
+    
+    tables = list(records["tables"])
+    kept = set(kept_ids)
+    kept_keys = {metadata.get("doc_id") for chunk_id, metadata in zip(bm25.ids, bm25.metadatas) if chunk_id in kept}
+    if kept_keys and TableStore.exists(TABLE_STORE_FILE):
+        tables.extend(table for table in TableStore.load(TABLE_STORE_FILE).tables if table["metadata"].get("doc_id") in kept_keys)
+    
+    # Tables are rebuilt the same way, from every table seen in this run plus those of kept documents
+    print(f"Building table store ({len(tables)} tables)...")
+    with profiling.span("table_store_build"):
+        TableStore.build(TABLE_STORE_FILE, tables)
+    
+    # Remember what the index was built from, so it can be checked and re-indexed without a source argument
+    previous = (read_index_version() or {}) if kept_ids else {}
+    indexed_keys = {document_key(document) for document in documents or []}
+    sources = [document for document in previous.get("documents", []) if document_key(document) in kept_keys - indexed_keys]
+    sources.extend(documents or [])
+    
+    # Stamp the new index version, and the embedding model with the vectors
+    if embedding_model:
+        store.set_embedding_model(embedding_model)
+    return write_index_version(compute_index_version(chunk_hashes, embedding_model), len(chunk_hashes), embedding_model=embedding_model, documents=sources)
+
+
+def open_checkpoints(incremental: bool = True) -> Optional[PageCheckpoints]:
+    if not INDEX_CHECKPOINTS:
+        return None
+    checkpoints = PageCheckpoints()
+    if not incremental:
+        # The collection was dropped, extracted text is kept but nothing counts as embedded
+        checkpoints.reset_status()
+    return checkpoints
+
+
+def report_profile():
+    trace = profiling.end_trace()
+    if trace:
+        print(profiling.format_trace(trace))
+
+
+def index_documents(documents: List[Dict[str, any]], API_KEY: str, chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+                    incremental: bool = True, batch_size: int = INDEX_PIPELINE_BATCH_SIZE, label: str = None, extracted_path: str = None) -> Tuple[str, int]:
+    """Index document descriptors ({"path", "doc_id", ...}) into the shared store, leaving other documents in it untouched.
+
+    A descriptor without a doc_id is indexed with the single-document id scheme (page_N_chunk_M).
+    """
+    profiling.start_trace("indexing", label or ", ".join(document["path"] for document in documents), shared=True)
+    
+    print(f"Opening vector store ({VECTOR_STORE_BACKEND})...")
+    store = open_vector_store(create=True, incremental=incremental)
+    
+    # Only ids and hashes are kept for the diff, not the stored vectors
+    stored_hashes = store.get_hashes() if incremental else {}
+    records = {"hashes": {}, "tables": []}
+    checkpoints = open_checkpoints(incremental)
+    
+    page_total = 0
+    try:
+        sources = [(document["path"], document if document_key(document) else None) for document in documents]
+        provider = prepare_embedding_provider(store, sources, API_KEY, incremental, chunk_size, chunk_overlap, checkpoints)
+        # Save extracted content for reference (optional)
+        with (open(extracted_path, "w", encoding="utf-8") if extracted_path else nullcontext()) as extracted_file:
+            for i, (pdf_path, document) in enumerate(sources, 1):
+                if document is not None:
+                    print(f"[{i}/{len(sources)}] {document['doc_id']}")
+                page_total += index_document(store, pdf_path, API_KEY, stored_hashes, records, document=document, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                             batch_size=batch_size, extracted_file=extracted_file, checkpoints=checkpoints)
+    finally:
+        if checkpoints is not None:
+            checkpoints.close()
+    
+    if not records["hashes"]:
+        profiling.end_trace()
         print("No content to index!")
         return COLLECTION_NAME, 0
     
-    print(f"Generating embeddings for {len(chunks_to_index)} chunks...")
-    texts = []
-    for chunk in chunks_to_index:
-        texts.append(chunk["text"])
-    embeddings = get_embeddings(texts, API_KEY)
-    
-    print("Creating vector store...")
-    collection = create_vector_store()
-    
-    # Add to ChromaDB
-    ids = []
-    metadatas = []
-    for chunk in chunks_to_index:
-        ids.append(chunk["id"])
-        metadatas.append(chunk["metadata"])
-    
-    collection.add(
-        documents=texts,
-        embeddings=embeddings,
-        metadatas=metadatas,
-        ids=ids
-    )
+    state = finalize_index(store, stored_hashes, records, provider.model, documents)
+    report_profile()
     
-    print(f"Successfully indexed {len(chunks_to_index)} chunks from {len(documents)} pages")
-    return COLLECTION_NAME, len(chunks_to_index)
+    print(f"Successfully indexed {len(records['hashes'])} chunks from {len(documents)} document{'s' if len(documents) != 1 else ''}, {page_total} pages "
+          f"({state['chunk_count']} chunks in the index, version {state['index_version']})")
+    return COLLECTION_NAME, len(records["hashes"])
+
+
+def index_pdf(pdf_path: str, API_KEY: str, chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP, incremental: bool = True, batch_size: int = INDEX_PIPELINE_BATCH_SIZE) -> Tuple[str, int]:
+    """Index a single PDF page by page so memory stays flat for large documents; other documents in the store are kept."""
+    return index_documents([{"path": pdf_path}], API_KEY, chunk_size, chunk_overlap, incremental, batch_size, label=pdf_path, extracted_path=EXTRACTED_CONTENT_FILE)
+
+
+def index_corpus(source: str, API_KEY: str, chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP, incremental: bool = True, batch_size: int = INDEX_PIPELINE_BATCH_SIZE) -> Tuple[str, int]:
+    """Index every PDF in a directory or manifest, tagging chunks with doc_id, year and section."""
+    documents = discover_documents(source)
+    if not documents:
+        print(f"No PDF documents found in {source}")
+        return COLLECTION_NAME, 0
+    return index_documents(documents, API_KEY, chunk_size, chunk_overlap, incremental, batch_size, label=source)
 
 # For manually running indexing.py
 if __name__ == "__main__":
+    import sys
     from dotenv import load_dotenv
     
     load_dotenv()
@@ -229,6 +792,16 @@ if __name__ == "__main__":
         raise ValueError("GEMINI_API_KEY not found in environment variables")
     
     
-    # index_pdf(PDF_FILE_PATH, API_KEY)
-    collection_name, chunk_count = index_pdf(PDF_FILE_PATH, API_KEY)
+    # Pass --rebuild to drop the collection and index from scratch
+    incremental = "--rebuild" not in sys.argv
+    if "--profile" in sys.argv:
+        profiling.enable()
+    # Optional source argument: a PDF, a directory of PDFs, or a JSON manifest
+    sources = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    
+    if sources and not sources[0].lower().endswith(".pdf"):
+        collection_name, chunk_count = index_corpus(sources[0], API_KEY, incremental=incremental)
+    else:
+        # index_pdf(PDF_FILE_PATH, API_KEY)
+        collection_name, chunk_count = index_pdf(sources[0] if sources else PDF_FILE_PATH, API_KEY, incremental=incremental)
     print(f"\nIndexing complete! Collection: {collection_name}, Chunks: {chunk_count}")
\ No newline at end of file
@@ -1,17 +1,50 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+
 import os
+import argparse
+import itertools
+import threading
 from dotenv import load_dotenv
-from indexing import index_pdf
-from retrieval import retrieve_relevant_chunks, rerank_chunks, deduplicate_chunks
-from generate import generate_answer
-from utils import render_markdown_response, print_thinking_animation, ConversationMemory
+from utils import render_streaming_response, print_thinking_animation, ConversationMemory, session_memory_path
+from index_state import check_index, embedding_model_matches, read_index_version
+import profiling
 from config import *
 from rich.console import Console
 from rich.prompt import Prompt
 
 
-def run_chatbot():
+def start_warmup(API_KEY: str):
+    """Import the retrieval and generation stack and open the index in the background while the user types."""
+    loaded = {}
+    
+    def warm():
+        try:
+            # These pull in google.generativeai and chromadb, several seconds of imports
+            from retrieval import Retriever
+            import pipeline
+            import generate
+            
+            retriever = Retriever(API_KEY)
+            retriever.store
+            retriever.bm25
+            retriever.tables
+            loaded.update(retriever=retriever, pipeline=pipeline, generate=generate)
+        except Exception as e:
+            loaded["error"] = e
+    
+    thread = threading.Thread(target=warm, name="warmup", daemon=True)
+    thread.start()
+    return thread, loaded
+
+
+def run_chatbot(profile: bool = False, session: str = None):
     console = Console()
     
+    if profile:
+        profiling.enable()
+        console.print(f"[dim]Profiling enabled, traces are appended to {PROFILE_OUTPUT_FILE}[/dim]")
+    
     # Load Gemini Api Key
     load_dotenv()
     API_KEY = os.getenv("GEMINI_API_KEY")
@@ -20,21 +53,33 @@ def run_chatbot():
         console.print("[yellow]Please create a .env file with your API key[/yellow]")
         return
     
-    # Check if PDF exists
-    if not os.path.exists(PDF_FILE_PATH):
-        console.print(f"[red]Error: PDF file '{PDF_FILE_PATH}' not found[/red]")
-        return
-    
-    # Check if index exists, if not create it
-    if not os.path.exists(CHROMA_DB_PATH):
-        console.print("No existing index found. Creating index...")
+    # Check the index without loading the vector store, build or update it if needed
+    ready, reason = check_index()
+    if not ready:
+        # Re-index whatever the index was built from (a corpus or a single PDF), PDF_FILE_PATH only for a first run
+        state = read_index_version()
+        documents = [document for document in (state or {}).get("documents", []) if os.path.exists(document["path"])]
+        if not documents:
+            if not os.path.exists(PDF_FILE_PATH):
+                console.print(f"[red]Error: index not ready ({reason}) and PDF file '{PDF_FILE_PATH}' not found[/red]")
+                return
+            documents = [{"path": PDF_FILE_PATH}]
+        
+        console.print(f"Index not ready ({reason}). Creating index...")
         console.print("Please wait...")
         
-        collection_name, chunk_count = index_pdf(PDF_FILE_PATH, API_KEY)
+        from indexing import index_documents  # PDF and vision dependencies are only needed here
+        # Vectors from another embedding provider cannot be updated in place
+        incremental = embedding_model_matches(state)
+        extracted_path = EXTRACTED_CONTENT_FILE if documents == [{"path": PDF_FILE_PATH}] else None
+        collection_name, chunk_count = index_documents(documents, API_KEY, incremental=incremental, extracted_path=extracted_path)
         console.print(f"✓ Index created successfully with {chunk_count} chunks\n")
     
-    # Initialize conversation memory
-    memory = ConversationMemory()
+    # Open the vector store once for the whole session, off the startup path
+    warmup, loaded = start_warmup(API_KEY)
+    
+    # Initialize conversation memory, a named session resumes from disk
+    memory = ConversationMemory(persist_path=session_memory_path(session) if session else None)
     
     # Start chatbot loop
     console.print("=" * 60)
@@ -42,6 +87,15 @@ def run_chatbot():
     console.print("=" * 60)
     console.print("Ask questions about the Financial Policy Document.")
     console.print("Type 'exit', 'quit', or 'q' to end the conversation.\n")
+    if not memory.is_empty():
+        console.print(f"[dim]Resumed session '{session}' ({memory.token_count()} tokens of history)[/dim]\n")
+    
+    if ready:
+        startup = time.perf_counter() - STARTUP_STARTED
+        if startup > STARTUP_BUDGET_SECONDS:
+            console.print(f"[yellow]Startup took {startup * 1000:.0f} ms, over the {STARTUP_BUDGET_SECONDS * 1000:.0f} ms budget[/yellow]")
+        elif profile:
+            console.print(f"[dim]Startup: {startup * 1000:.0f} ms to prompt (budget {STARTUP_BUDGET_SECONDS * 1000:.0f} ms)[/dim]")
     
     while True:
         # Get user input
@@ -61,31 +115,52 @@ def run_chatbot():
             continue
         
         try:
+            profiling.start_trace("question", query)
+            
             # Show thinking animation
             with print_thinking_animation():
-                # Retrieve relevant chunks
-                chunks = retrieve_relevant_chunks(query=query, API_KEY=API_KEY, top_k=DEFAULT_TOP_K)
+                # Only the first question can still be waiting on the warm-up
+                with profiling.span("warmup_wait"):
+                    warmup.join()
+                if "error" in loaded:
+                    raise loaded["error"]
+                pipeline = loaded["pipeline"]
+                history = memory.get_formatted_history()
                 
-                # Rerank and deduplicate
-                chunks = rerank_chunks(chunks, query, API_KEY)
-                chunks = deduplicate_chunks(chunks)
+                # Retrieve, rerank and deduplicate chunks
+                chunks, timings = pipeline.prepare_chunks(loaded["retriever"], query, API_KEY)
                 
-                # Limit to top chunks for generation
-                chunks = chunks[:MAX_CHUNKS_FOR_GENERATION]
-                
-                # Generate answer
-                result = generate_answer(
-                    query=query,
-                    chunks=chunks,
-                    API_KEY=API_KEY,
-                    conversation_history=memory.get_formatted_history()
-                )
+                # Reuse the answer to an earlier paraphrase, or generate and keep the spinner until the first token arrives
+                cached = pipeline.lookup_answer(query, chunks, API_KEY, history)
+                if cached is not None:
+                    events = pipeline.cached_answer_events(cached)
+                else:
+                    events = loaded["generate"].generate_answer_stream(
+                        query=query,
+                        chunks=chunks,
+                        API_KEY=API_KEY,
+                        conversation_history=history
+                    )
+                first_event = next(events)
             
-            # Display answer
+            # Display answer as it streams in
             console.print()  # Just add a newline
-            render_markdown_response(result['answer'])
+            result = render_streaming_response(itertools.chain([first_event], events), console)
+            
+            pipeline.store_answer(query, chunks, API_KEY, history, result)
+            
+            ttft = result.get('time_to_first_token')
+            ttft_info = f"{ttft:.2f}s" if ttft is not None else "n/a"
+            generation_info = "answer reused from cache" if result.get('cached') else f"First token: {ttft_info}, total generation: {result['total_time']:.2f}s"
+            console.print(f"[dim]Retrieval: embed {timings['embed'] * 1000:.0f} ms, search {timings['search'] * 1000:.0f} ms | "
+                          f"Context: {result.get('context_tokens', 0)} tokens ({result.get('context_tokens_saved', 0)} saved) | "
+                          f"{generation_info}[/dim]")
             console.print("[blue]" + "─" * 60 + "[/blue]")
             
+            trace = profiling.end_trace()
+            if trace:
+                console.print(f"[dim]{profiling.format_trace(trace)}[/dim]")
+            
             # Add exchange to memory
             memory.add_exchange(query, result['answer'])
             
@@ -93,13 +168,19 @@ def run_chatbot():
             console.print("\n")
             break
         except Exception as e:
+            profiling.end_trace()
             console.print(f"[red]Error processing your question: {e}[/red]")
             console.print("[yellow]Please try again with a different question.[/yellow]")
 
     console.print("\n[green]Thank you for using the chatbot.[/green]")
 
 def main():
-    run_chatbot()
+    parser = argparse.ArgumentParser(description=CHATBOT_TITLE)
+    parser.add_argument("--profile", action="store_true", help="Print a per-stage latency breakdown for each question and export it as JSON lines")
+    parser.add_argument("--session", help="Name of a conversation to save and resume across runs")
+    args = parser.parse_args()
+    
+    run_chatbot(profile=args.profile, session=args.session)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
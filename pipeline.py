@@ -0,0 +1,98 @@
+from typing import List, Dict, Tuple, Iterator, Optional
+import threading
+import time
+from retrieval import Retriever, rerank_chunks, deduplicate_chunks, get_query_embedding
+from generate import generate_answer
+from cache import AnswerCache
+from index_state import current_index_version
+import profiling
+from config import *
+
+# Fields of a generation result that are reused on a cache hit
+CACHED_RESULT_FIELDS = ("answer", "source_pages", "chunks_used", "context_tokens", "context_tokens_saved")
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache()
+        return _answer_cache
+
+
+def lookup_answer(query: str, chunks: List[Dict[str, any]], API_KEY: str, conversation_history: str = "",
+                  query_embedding: List[float] = None) -> Optional[Dict[str, any]]:
+    """Return a cached answer for a paraphrase of an earlier question over the same chunks, or None."""
+    if not ANSWER_CACHE_ENABLED or not chunks:
+        return None
+    with profiling.span("answer_cache"):
+        # Retrieval has just embedded this query, so this is a query cache hit
+        if query_embedding is None:
+            query_embedding = get_query_embedding(query, API_KEY)
+        result = get_answer_cache().get(query_embedding, [chunk["id"] for chunk in chunks], conversation_history, current_index_version())
+    if result is not None:
+        result["cached"] = True
+    return result
+
+
+def store_answer(query: str, chunks: List[Dict[str, any]], API_KEY: str, conversation_history: str, result: Dict[str, any],
+                 query_embedding: List[float] = None):
+    # Empty or blocked responses are not worth reusing
+    if not ANSWER_CACHE_ENABLED or not chunks or not result.get("chunks_used") or result.get("cached"):
+        return
+    if query_embedding is None:
+        query_embedding = get_query_embedding(query, API_KEY)
+    cached = {field: result[field] for field in CACHED_RESULT_FIELDS if field in result}
+    get_answer_cache().put(query_embedding, [chunk["id"] for chunk in chunks], conversation_history, current_index_version(), cached)
+
+
+def cached_answer_events(result: Dict[str, any]) -> Iterator[Dict[str, any]]:
+    # Same event shape as generate_answer_stream, delivered at once
+    yield {"type": "delta", "text": result["answer"]}
+    yield dict(result, type="done", time_to_first_token=0.0, total_time=0.0)
+
+
+def prepare_chunks(retriever: Retriever, query: str, API_KEY: str, top_k: int = DEFAULT_TOP_K, filters: Dict[str, any] = None,
+                   query_embedding: List[float] = None) -> Tuple[List[Dict[str, any]], Dict[str, float]]:
+    # Retrieve relevant chunks
+    chunks, timings = retriever.retrieve_with_timings(query, top_k=top_k, filters=filters, query_embedding=query_embedding)
+    
+    # Rerank and deduplicate
+    with profiling.span("rerank"):
+        chunks = rerank_chunks(chunks, query, API_KEY)
+    with profiling.span("dedup"):
+        chunks = deduplicate_chunks(chunks)
+    
+    # Questions naming a table or row get just those rows, plus a little text for context
+    start = time.perf_counter()
+    table_chunks = retriever.lookup_tables(query, filters)
+    timings["table_lookup"] = time.perf_counter() - start
+    profiling.record("table_lookup", timings["table_lookup"])
+    if table_chunks:
+        return table_chunks + chunks[:TABLE_FASTPATH_TEXT_CHUNKS], timings
+    
+    # Limit to top chunks for generation
+    return chunks[:MAX_CHUNKS_FOR_GENERATION], timings
+
+
+def answer_question(retriever: Retriever, query: str, API_KEY: str, conversation_history: str = "", filters: Dict[str, any] = None,
+                    query_embedding: List[float] = None) -> Dict[str, any]:
+    chunks, timings = prepare_chunks(retriever, query, API_KEY, filters=filters, query_embedding=query_embedding)
+    
+    start = time.perf_counter()
+    result = lookup_answer(query, chunks, API_KEY, conversation_history, query_embedding)
+    if result is None:
+        result = generate_answer(
+            query=query,
+            chunks=chunks,
+            API_KEY=API_KEY,
+            conversation_history=conversation_history
+        )
+        store_answer(query, chunks, API_KEY, conversation_history, result, query_embedding)
+    timings["generate"] = time.perf_counter() - start
+    
+    result["timings"] = timings
+    return result
@@ -0,0 +1,109 @@
+from typing import Dict, Optional
+from contextlib import contextmanager
+import json
+import threading
+import time
+from config import *
+
+_enabled = False
+_output_path = None
+_local = threading.local()  # Per-thread trace for concurrent questions
+_shared_trace = None  # Process-wide trace, used when work fans out to helper threads (indexing)
+_lock = threading.Lock()
+
+
+def enable(output_path: Optional[str] = PROFILE_OUTPUT_FILE):
+    global _enabled, _output_path
+    _enabled = True
+    _output_path = output_path
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def _current_trace() -> Optional[dict]:
+    return getattr(_local, "trace", None) or _shared_trace
+
+
+def start_trace(kind: str, label: str = "", shared: bool = False):
+    """Begin collecting spans; shared traces also collect spans from other threads."""
+    global _shared_trace
+    if not _enabled:
+        return
+    trace = {"kind": kind, "label": label, "started_at": time.time(), "start": time.perf_counter(), "spans": {}, "tokens": {}}
+    if shared:
+        _shared_trace = trace
+    else:
+        _local.trace = trace
+
+
+def record(name: str, seconds: float):
+    trace = _current_trace()
+    if trace is None:
+        return
+    with _lock:
+        span_stats = trace["spans"].setdefault(name, {"seconds": 0.0, "count": 0})
+        span_stats["seconds"] += seconds
+        span_stats["count"] += 1
+
+
+def record_tokens(**counts):
+    # e.g. record_tokens(prompt=812, output=240)
+    trace = _current_trace()
+    if trace is None:
+        return
+    with _lock:
+        for name, value in counts.items():
+            if value is not None:
+                trace["tokens"][name] = trace["tokens"].get(name, 0) + value
+
+
+@contextmanager
+def span(name: str):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def end_trace() -> Optional[Dict[str, any]]:
+    global _shared_trace
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        _local.trace = None
+    else:
+        trace, _shared_trace = _shared_trace, None
+    if trace is None:
+        return None
+
+    result = {
+        "kind": trace["kind"],
+        "label": trace["label"],
+        "started_at": trace["started_at"],
+        "total_seconds": time.perf_counter() - trace["start"],
+        "spans": trace["spans"],
+        "tokens": trace["tokens"]
+    }
+
+    # One JSON object per line so runs can be appended and compared
+    if _output_path:
+        with _lock, open(_output_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+
+    return result
+
+
+def format_trace(trace: Dict[str, any]) -> str:
+    lines = [f"Profile ({trace['kind']}): total {trace['total_seconds'] * 1000:.0f} ms"]
+    for name, stats in sorted(trace["spans"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+        share = stats["seconds"] / trace["total_seconds"] * 100 if trace["total_seconds"] else 0
+        calls = f" x{stats['count']}" if stats["count"] > 1 else ""
+        lines.append(f"  {name:<18} {stats['seconds'] * 1000:>9.1f} ms  {share:5.1f}%{calls}")
+    if trace["tokens"]:
+        lines.append("  tokens: " + ", ".join(f"{name}={value}" for name, value in trace["tokens"].items()))
+    return "\n".join(lines)
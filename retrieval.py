@@ -1,62 +1,228 @@
-from typing import List, Dict
-import chromadb
+from typing import List, Dict, Tuple, Optional
+import threading
+import time
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
+from cache import EmbeddingCache, QueryEmbeddingCache
+from bm25 import BM25Index, reciprocal_rank_fusion
+from tables import TableStore
+import profiling
+from embeddings import get_embedding_provider, check_embedding_model
+from index_state import current_index_state
+from vector_store import VectorStore, open_vector_store
 from config import *
 
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> QueryEmbeddingCache:
+    global _query_cache
+    with _query_cache_lock:
+        if _query_cache is None:
+            persistent = EmbeddingCache() if QUERY_CACHE_PERSIST else None
+            _query_cache = QueryEmbeddingCache(persistent=persistent)
+        return _query_cache
+
+
 def get_query_embedding(query: str, API_KEY: str) -> List[float]:
+    provider = get_embedding_provider(API_KEY)
+    if not provider.cache_embeddings:
+        # Local query encoding is in-process and cheaper than a cache lookup
+        return provider.embed_query(query)
 
-    genai.configure(api_key=API_KEY)
-    
-    result = genai.embed_content(
-        model=EMBEDDING_MODEL,
-        content=query,
-        task_type="retrieval_query"
-    )
-    return result['embedding']
+    # Repeat questions skip the embedding call entirely
+    cache = get_query_cache()
+    cached = cache.get(query)
+    if cached is not None:
+        return cached
 
+    embedding = provider.embed_query(query)
+    cache.put(query, embedding)
+    return embedding
 
-def retrieve_relevant_chunks(query: str, API_KEY: str, top_k: int = 5, persist_directory: str = CHROMA_DB_PATH
-) -> List[Dict[str, any]]:
 
-    # Get query embedding
-    query_embedding = get_query_embedding(query, API_KEY)
+def get_query_embeddings(queries: List[str], API_KEY: str, batch_size: int = QUERY_EMBEDDING_BATCH_SIZE) -> List[List[float]]:
+    """Embed many queries with one request per batch instead of one per query (batch mode)."""
+    provider = get_embedding_provider(API_KEY)
+    if not provider.cache_embeddings:
+        return provider.embed_queries(queries)
     
-    # Connect to ChromaDB
-    client = chromadb.PersistentClient(path=persist_directory)
-    collection = client.get_collection(name=COLLECTION_NAME)
+    cache = get_query_cache()
+    embeddings = [cache.get(query) for query in queries]
     
-    # Search for similar chunks
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=top_k
-    )
+    # Identical questions are embedded once
+    missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
     
-    # Format results
-    retrieved_chunks = []
+    embedded = {}
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        for query, embedding in zip(batch, provider.embed_queries(batch)):
+            cache.put(query, embedding)
+            embedded[query] = embedding
     
-    if results and results['documents']:
-        documents = results['documents'][0]
-        metadatas_list = results['metadatas'][0] if results['metadatas'] else []
-        distances_list = results['distances'][0] if results['distances'] else []
-        ids_list = results['ids'][0] if results['ids'] else []
+    return [embedding if embedding is not None else embedded[query] for query, embedding in zip(queries, embeddings)]
+
+
+class Retriever:
+    """Keeps one vector store handle open for the process lifetime."""
+
+    def __init__(self, API_KEY: str, persist_directory: str = CHROMA_DB_PATH, hybrid: bool = HYBRID_RETRIEVAL, bm25_path: str = BM25_INDEX_PATH, backend: str = VECTOR_STORE_BACKEND,
+                 table_store_path: str = TABLE_STORE_FILE, index_version_path: str = INDEX_VERSION_FILE):
+        self.API_KEY = API_KEY
+        self.persist_directory = persist_directory
+        self.backend = backend
+        self.hybrid = hybrid
+        self.bm25_path = bm25_path
+        self._store = None
+        self._bm25 = None
+        self.table_store_path = table_store_path
+        self._tables = None
+        self.index_version_path = index_version_path
+        self._loaded_run = self._index_run()
+        self._lock = threading.Lock()
+        # Lexical search runs here while the caller's thread embeds and queries Chroma
+        self._executor = ThreadPoolExecutor(max_workers=4) if hybrid else None
+        genai.configure(api_key=API_KEY)
+
+    @property
+    def store(self) -> VectorStore:
+        # Open lazily, once, even if several threads ask at the same time
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    store = open_vector_store(self.backend, persist_directory=self.persist_directory)
+                    # Queries embedded by another model than the stored vectors would retrieve noise
+                    check_embedding_model(store.get_embedding_model(), get_embedding_provider(self.API_KEY))
+                    self._store = store
+        return self._store
+
+    @property
+    def bm25(self) -> Optional[BM25Index]:
+        if self._bm25 is None and BM25Index.exists(self.bm25_path):
+            with self._lock:
+                if self._bm25 is None:
+                    self._bm25 = BM25Index.load(self.bm25_path)
+        return self._bm25
+
+    @property
+    def tables(self) -> Optional[TableStore]:
+        if self._tables is None and TableStore.exists(self.table_store_path):
+            with self._lock:
+                if self._tables is None:
+                    self._tables = TableStore.load(self.table_store_path)
+        return self._tables
+
+    def lookup_tables(self, query: str, filters: Dict[str, any] = None) -> List[Dict[str, any]]:
+        # Exact table ids and row labels, answered from the parsed table store without embeddings
+        self._sync_index()
+        tables = self.tables if TABLE_LOOKUP else None
+        return tables.lookup(query, filters) if tables is not None else []
+
+    def reload(self):
+        # Drop the cached handles so the next query picks up a rebuilt index
+        with self._lock:
+            self._store = None
+            self._bm25 = None
+            self._tables = None
+
+    def _index_run(self) -> Tuple[Optional[str], Optional[float]]:
+        # A --rebuild of unchanged content keeps the version but recreates the collection, so the run time counts too
+        state = current_index_state(self.index_version_path)
+        return state.get("index_version"), state.get("updated_at")
+
+    def _sync_index(self):
+        # Indexing writes the version file last, once the store, BM25 and tables are all in place
+        run = self._index_run()
+        if run != self._loaded_run:
+            self.reload()
+            self._loaded_run = run
+
+    def _lexical_search(self, query: str, n_results: int, filters: Dict[str, any] = None) -> Tuple[List[Dict[str, any]], float]:
+        start = time.perf_counter()
+        bm25 = self.bm25
+        results = bm25.search(query, n_results, filters) if bm25 is not None else []
+        return results, time.perf_counter() - start
+
+    def retrieve_with_timings(self, query: str, top_k: int = DEFAULT_TOP_K, filters: Dict[str, any] = None,
+                              query_embedding: List[float] = None) -> Tuple[List[Dict[str, any]], Dict[str, float]]:
+        """Filters like {"doc_id": "budget_2024"} or {"year": [2023, 2024]} restrict the search to that slice.
         
-        # Ensure all lists have same length as documents
-        while len(metadatas_list) < len(documents):
-            metadatas_list.append({})
-        while len(distances_list) < len(documents):
-            distances_list.append(0)
-        while len(ids_list) < len(documents):
-            ids_list.append('')
+        A precomputed query_embedding (e.g. from get_query_embeddings) skips the embedding call.
+        """
+        self._sync_index()
+        timings = {}
+        n_results = top_k * HYBRID_CANDIDATE_MULTIPLIER if self.hybrid else top_k
         
-        for i in range(len(documents)):
-            retrieved_chunks.append({
-                "id": ids_list[i],
-                "text": documents[i],
-                "metadata": metadatas_list[i],
-                "score": 1 - distances_list[i]  # Convert distance to similarity score
-            })
-    
-    return retrieved_chunks
+        lexical_future = self._executor.submit(self._lexical_search, query, n_results, filters) if self.hybrid else None
+        
+        start = time.perf_counter()
+        if query_embedding is None:
+            query_embedding = get_query_embedding(query, self.API_KEY)
+        timings["embed"] = time.perf_counter() - start
+        profiling.record("query_embed", timings["embed"])
+        
+        start = time.perf_counter()
+        vector_chunks = self.store.query(query_embedding, n_results, filters)
+        timings["search"] = time.perf_counter() - start
+        profiling.record("vector_search", timings["search"])
+        
+        if lexical_future is None:
+            return vector_chunks, timings
+        
+        lexical_chunks, timings["lexical"] = lexical_future.result()
+        profiling.record("lexical_search", timings["lexical"])
+        if not lexical_chunks:
+            return vector_chunks[:top_k], timings
+        
+        with profiling.span("fusion"):
+            fused = reciprocal_rank_fusion({"vector": vector_chunks, "bm25": lexical_chunks})[:top_k]
+            self._attach_texts(fused)
+            self._attach_embeddings(fused)
+        return fused, timings
+
+    def _attach_texts(self, chunks: List[Dict[str, any]]):
+        # BM25 keeps no texts, lexical-only hits read theirs from the vector store
+        missing = [chunk for chunk in chunks if "text" not in chunk]
+        if not missing:
+            return
+        documents = self.store.get_documents([chunk["id"] for chunk in missing])
+        for chunk in missing:
+            chunk["text"] = documents.get(chunk["id"], ("", {}))[0]
+
+    def _attach_embeddings(self, chunks: List[Dict[str, any]]):
+        # Lexical-only hits have no embedding yet, dedup needs one for every chunk
+        missing = [chunk for chunk in chunks if chunk.get("embedding") is None]
+        if not missing:
+            return
+        by_id = self.store.get_embeddings([chunk["id"] for chunk in missing])
+        for chunk in missing:
+            if chunk["id"] in by_id:
+                chunk["embedding"] = by_id[chunk["id"]]
+
+    def retrieve(self, query: str, top_k: int = DEFAULT_TOP_K, filters: Dict[str, any] = None) -> List[Dict[str, any]]:
+        chunks, _ = self.retrieve_with_timings(query, top_k, filters)
+        return chunks
+
+
+_retrievers = {}
+_retrievers_lock = threading.Lock()
+
+
+def get_retriever(API_KEY: str, persist_directory: str = CHROMA_DB_PATH) -> Retriever:
+    with _retrievers_lock:
+        retriever = _retrievers.get(persist_directory)
+        if retriever is None or retriever.API_KEY != API_KEY:
+            retriever = Retriever(API_KEY, persist_directory)
+            _retrievers[persist_directory] = retriever
+        return retriever
+
+
+def retrieve_relevant_chunks(query: str, API_KEY: str, top_k: int = 5, persist_directory: str = CHROMA_DB_PATH
+) -> List[Dict[str, any]]:
+    return get_retriever(API_KEY, persist_directory).retrieve(query, top_k)
 
 
 def rerank_chunks(chunks: List[Dict[str, any]], query: str, API_KEY: str) -> List[Dict[str, any]]:
@@ -66,11 +232,62 @@ def rerank_chunks(chunks: List[Dict[str, any]], query: str, API_KEY: str) -> Lis
     return reranked
 
 
+def cosine_duplicates(embeddings: np.ndarray, similarity_threshold: float) -> List[int]:
+    # Greedy in rank order: keep a chunk unless it is too close to one already kept
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    normalized = embeddings / np.maximum(norms, 1e-12)
+    similarity = normalized @ normalized.T
+
+    kept = []
+    for i in range(len(embeddings)):
+        if not kept or similarity[i, kept].max() < similarity_threshold:
+            kept.append(i)
+    return kept
+
+
+def shingle_hashes(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    words = text.lower().split()
+    if len(words) < size:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return np.array(sorted(set(zlib.crc32(s.encode("utf-8")) for s in shingles)), dtype=np.uint64)
+
+
+def minhash_signatures(texts: List[str], num_perm: int = MINHASH_NUM_PERM) -> np.ndarray:
+    prime = np.uint64((1 << 31) - 1)
+    rng = np.random.default_rng(0)
+    a = rng.integers(1, int(prime), size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, int(prime), size=num_perm, dtype=np.uint64)
+
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        # Values stay below 2^31, so a * x fits in uint64 without overflow
+        x = shingle_hashes(text) % prime
+        signatures[i] = ((np.outer(a, x) + b[:, None]) % prime).min(axis=1)
+    return signatures
+
+
+def minhash_duplicates(texts: List[str], similarity_threshold: float) -> List[int]:
+    signatures = minhash_signatures(texts)
+
+    kept = []
+    for i in range(len(texts)):
+        if kept:
+            # Estimated Jaccard similarity against every kept chunk at once
+            jaccard = (signatures[kept] == signatures[i]).mean(axis=1)
+            if jaccard.max() >= similarity_threshold:
+                continue
+        kept.append(i)
+    return kept
+
+
 def deduplicate_chunks(chunks: List[Dict[str, any]], similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD) -> List[Dict[str, any]]:
 
     if not chunks:
         return []
     
+    # Exact duplicates first, cheap and catches repeated boilerplate
     unique_chunks = []
     seen_texts = set()
     
@@ -81,4 +298,14 @@ def deduplicate_chunks(chunks: List[Dict[str, any]], similarity_threshold: float
             seen_texts.add(text)
             unique_chunks.append(chunk)
     
-    return unique_chunks
\ No newline at end of file
+    if len(unique_chunks) < 2:
+        return unique_chunks
+    
+    has_embeddings = all(chunk.get('embedding') is not None for chunk in unique_chunks)
+    if has_embeddings and len(unique_chunks) <= DEDUP_MINHASH_MIN_CANDIDATES:
+        embeddings = np.array([chunk['embedding'] for chunk in unique_chunks], dtype=np.float32)
+        kept = cosine_duplicates(embeddings, similarity_threshold)
+    else:
+        kept = minhash_duplicates([chunk['text'] for chunk in unique_chunks], similarity_threshold)
+    
+    return [unique_chunks[i] for i in kept]
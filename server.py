@@ -0,0 +1,217 @@
+from typing import Dict, Tuple
+import asyncio
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from dotenv import load_dotenv
+from retrieval import Retriever
+from pipeline import answer_question, get_answer_cache
+from utils import ConversationMemory, session_memory_path
+from config import *
+
+
+class Session:
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.memory = ConversationMemory(persist_path=session_memory_path(session_id, SERVER_SESSION_DIR) if MEMORY_PERSIST_SESSIONS else None)
+        self.lock = asyncio.Lock()  # One question at a time per conversation
+        self.last_used = time.time()
+
+
+class ChatServer:
+    """Asyncio HTTP/JSON server, one ConversationMemory per session, shared retriever and model client."""
+
+    def __init__(self, API_KEY: str, max_concurrency: int = SERVER_MAX_CONCURRENCY, session_ttl: float = SERVER_SESSION_TTL_SECONDS):
+        self.API_KEY = API_KEY
+        self.retriever = Retriever(API_KEY)
+        self.sessions: Dict[str, Session] = {}
+        self.session_ttl = session_ttl
+        self._last_file_sweep = 0.0
+        # Blocking Gemini/Chroma calls run here so the event loop stays free
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.semaphore = None  # Created inside the running loop
+
+    def get_session(self, session_id: str = None) -> Session:
+        self.expire_sessions()
+        if not session_id or session_id not in self.sessions:
+            session_id = session_id or uuid.uuid4().hex
+            self.sessions[session_id] = Session(session_id)
+        session = self.sessions[session_id]
+        session.last_used = time.time()
+        return session
+
+    def expire_sessions(self):
+        now = time.time()
+        expired = [
+            sid for sid, session in self.sessions.items()
+            if now - session.last_used > self.session_ttl and not session.lock.locked()
+        ]
+        for sid in expired:
+            del self.sessions[sid]
+        if MEMORY_PERSIST_SESSIONS and now - self._last_file_sweep >= SERVER_SESSION_SWEEP_SECONDS:
+            self._last_file_sweep = now
+            self.sweep_session_files(now)
+
+    def sweep_session_files(self, now: float):
+        # Persisted conversations expire like in-memory ones, files of live sessions are kept
+        active = {session_memory_path(sid, SERVER_SESSION_DIR) for sid in self.sessions}
+        try:
+            names = os.listdir(SERVER_SESSION_DIR)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(SERVER_SESSION_DIR, name)
+            if not name.endswith((".json", ".tmp")) or path in active:
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.session_ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    async def chat(self, payload: Dict[str, any]) -> Tuple[int, Dict[str, any]]:
+        question = payload.get("question")
+        if not isinstance(question, str) or not question.strip():
+            return 400, {"error": "Missing 'question'"}
+        question = question.strip()
+
+        session_id = payload.get("session_id")
+        if session_id is not None and not isinstance(session_id, str):
+            return 400, {"error": "'session_id' must be a string"}
+
+        filters = payload.get("filters")
+        if filters is not None and not isinstance(filters, dict):
+            return 400, {"error": "'filters' must be an object, e.g. {\"doc_id\": \"budget_2024\"}"}
+
+        session = self.get_session(session_id)
+        loop = asyncio.get_running_loop()
+
+        async with session.lock:
+            async with self.semaphore:
+                result = await loop.run_in_executor(
+                    self.executor,
+                    partial(answer_question, self.retriever, question, self.API_KEY, session.memory.get_formatted_history(), filters)
+                )
+            # Persisting the session writes a file, keep it off the event loop
+            await loop.run_in_executor(self.executor, session.memory.add_exchange, question, result["answer"])
+
+        return 200, {
+            "session_id": session.session_id,
+            "answer": result["answer"],
+            "source_pages": result["source_pages"],
+            "chunks_used": result["chunks_used"],
+            "cached": result.get("cached", False),
+            "timings": result["timings"]
+        }
+
+    async def reset(self, session_id: str) -> Tuple[int, Dict[str, any]]:
+        # A session that expired from memory or predates a restart may still have its history on disk
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(session_id)
+        if session is not None:
+            async with session.lock:
+                await loop.run_in_executor(self.executor, session.memory.clear_history)
+            return 200, {"session_id": session_id, "status": "cleared"}
+        path = session_memory_path(session_id, SERVER_SESSION_DIR)
+        if MEMORY_PERSIST_SESSIONS and os.path.exists(path):
+            await loop.run_in_executor(self.executor, os.remove, path)
+            return 200, {"session_id": session_id, "status": "cleared"}
+        return 404, {"error": "Unknown session"}
+
+    async def route(self, method: str, path: str, payload: Dict[str, any]) -> Tuple[int, Dict[str, any]]:
+        if method == "GET" and path == "/health":
+            health = {"status": "ok", "sessions": len(self.sessions)}
+            if ANSWER_CACHE_ENABLED:
+                health["answer_cache"] = get_answer_cache().stats()
+            return 200, health
+        if method == "POST" and path == "/chat":
+            return await self.chat(payload)
+        if method == "POST" and path == "/reset":
+            session_id = payload.get("session_id")
+            if not isinstance(session_id, str):
+                return 400, {"error": "'session_id' must be a string"}
+            return await self.reset(session_id)
+        return 404, {"error": f"No route for {method} {path}"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+            # Read headers up to the blank line
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            body = b""
+            content_length = int(headers.get("content-length", 0))
+            if content_length:
+                body = await reader.readexactly(content_length)
+
+            try:
+                payload = json.loads(body) if body else {}
+            except ValueError:
+                payload = None
+
+            if not isinstance(payload, dict):
+                status, response = 400, {"error": "Request body must be a JSON object"}
+            else:
+                try:
+                    status, response = await self.route(method.upper(), path.split("?", 1)[0], payload)
+                except Exception as e:
+                    status, response = 500, {"error": str(e)}
+
+            await self.write_response(writer, status, response)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def write_response(self, writer: asyncio.StreamWriter, status: int, response: Dict[str, any]):
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+        data = json.dumps(response).encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {reasons.get(status, 'OK')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+    async def serve(self, host: str = SERVER_HOST, port: int = SERVER_PORT):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} (POST /chat, POST /reset, GET /health)")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    load_dotenv()
+    API_KEY = os.getenv("GEMINI_API_KEY")
+    if not API_KEY:
+        raise ValueError("GEMINI_API_KEY not found in environment variables")
+
+    server = ChatServer(API_KEY)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+from typing import List, Dict, Optional
+from contextlib import closing
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from bm25 import tokenize
+from vector_store import matches_filters
+from config import *
+
+TABLE_BLOCK_PATTERN = re.compile(r"---TABLE_START---(.*?)---TABLE_END---(.*?)(?=---TABLE_START---|\Z)", re.DOTALL)
+TABLE_ID_PATTERN = re.compile(r"Table\s+(\d+(?:\.\d+)+)", re.IGNORECASE)
+SEPARATOR_CELL = re.compile(r"^:?-+:?$")
+
+# Words that carry no meaning when matching row labels against a question
+LABEL_STOPWORDS = {"the", "of", "and", "for", "in", "to", "a", "an", "on", "by", "total", "sub"}
+
+
+def clean_cell(cell: str) -> str:
+    cell = re.sub(r"<br\s*/?>", " ", cell)
+    cell = cell.replace("**", "").replace("__", "")
+    return " ".join(cell.split())
+
+
+def parse_number(raw: str) -> Optional[float]:
+    """Numeric value of a table cell like "9 905", "-  91.5", "(12.3)", "$1,204m" or "4.5%", else None."""
+    text = re.sub(r"[$,%]", "", raw).strip()
+    text = re.sub(r"(?<=\d)\s*(?:m|bn|k)$", "", text)  # Unit suffixes like 1204m
+    negative = text.startswith("(") and text.endswith(")")
+    text = text.strip("()").strip()
+    if text.startswith("-") or text.startswith("–"):
+        negative = True
+        text = text[1:].strip()
+    # Thousands are often separated by spaces in the budget papers
+    text = re.sub(r"(?<=\d)\s+(?=\d)", "", text)
+    if not re.fullmatch(r"\d*\.?\d+", text):
+        return None
+    value = float(text)
+    return -value if negative else value
+
+
+def parse_table_blocks(page_text: str) -> List[Dict[str, any]]:
+    """Parse the ---TABLE_START---/---TABLE_END--- blocks written by vision extraction."""
+    tables = []
+    for body, trailer in TABLE_BLOCK_PATTERN.findall(page_text):
+        title = ""
+        rows = []
+        for line in body.strip().split("\n"):
+            line = line.strip()
+            if line.startswith("|"):
+                cells = [clean_cell(cell) for cell in line.strip("|").split("|")]
+                if all(SEPARATOR_CELL.match(cell) for cell in cells if cell):
+                    continue
+                rows.append(cells)
+            elif line and not title:
+                title = clean_cell(line.lstrip("#").strip())
+        if len(rows) < 2:
+            continue
+
+        headers, rows = rows[0], rows[1:]
+        match = TABLE_ID_PATTERN.search(title) or TABLE_ID_PATTERN.search(body)
+        # The summary is the first paragraph after the table
+        summary = trailer.strip().split("\n\n")[0].strip()
+        tables.append({
+            "table_id": match.group(1) if match else None,
+            "title": title,
+            "headers": headers,
+            "rows": rows,
+            "summary": summary
+        })
+    return tables
+
+
+def header_key(header: str) -> set:
+    # Year-like tokens identify a column ("2005-06 Budget $m" -> {"2005", "06"}), otherwise all words
+    tokens = set(tokenize(header))
+    return {token for token in tokens if any(c.isdigit() for c in token)} or tokens
+
+
+def format_table(title: str, headers: List[str], rows: List[List[str]]) -> str:
+    lines = [f"### {title}" if title else "### Table"]
+    lines.append("|" + "|".join(headers) + "|")
+    lines.append("|" + "|".join("-" for _ in headers) + "|")
+    lines.extend("|" + "|".join(row) + "|" for row in rows)
+    return "\n".join(lines)
+
+
+class TableStore:
+    """Parsed tables in SQLite (tables and typed cells), scanned in memory for row-level lookups."""
+
+    def __init__(self, tables: List[Dict[str, any]]):
+        self.tables = tables
+        self.by_id = {}
+        for table in tables:
+            if table["table_id"]:
+                self.by_id.setdefault(table["table_id"], []).append(table)
+            # Tokenized once here, every lookup compares against these
+            table["label_tokens"] = [set(tokenize(row[0] if row else "")) - LABEL_STOPWORDS for row in table["rows"]]
+            table["header_tokens"] = [header_key(header) for header in table["headers"]]
+
+    @staticmethod
+    def build(path: str, tables: List[Dict[str, any]]):
+        """Write tables (as collected during indexing, with page and metadata) to a fresh database."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Build next to the live file and swap it in, readers never see a half-written store
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with closing(sqlite3.connect(tmp_path)) as conn:
+            conn.execute(
+                """CREATE TABLE tables (
+                    table_key INTEGER PRIMARY KEY,
+                    table_id TEXT,
+                    title TEXT NOT NULL,
+                    page INTEGER,
+                    headers TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    metadata TEXT NOT NULL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE cells (
+                    table_key INTEGER NOT NULL,
+                    row_index INTEGER NOT NULL,
+                    col_index INTEGER NOT NULL,
+                    row_label TEXT NOT NULL,
+                    header TEXT NOT NULL,
+                    raw TEXT NOT NULL,
+                    value REAL
+                )"""
+            )
+            conn.execute("CREATE INDEX idx_tables_table_id ON tables (table_id)")
+            conn.execute("CREATE INDEX idx_cells_table ON cells (table_key, row_index)")
+
+            for table_key, table in enumerate(tables):
+                conn.execute(
+                    "INSERT INTO tables VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (table_key, table["table_id"], table["title"], table.get("page"), json.dumps(table["headers"]),
+                     table["summary"], json.dumps(table.get("metadata", {})))
+                )
+                conn.executemany(
+                    "INSERT INTO cells VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (table_key, row_index, col_index, row[0] if row else "",
+                         table["headers"][col_index] if col_index < len(table["headers"]) else "", raw, parse_number(raw))
+                        for row_index, row in enumerate(table["rows"])
+                        for col_index, raw in enumerate(row)
+                    ]
+                )
+            conn.commit()
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str = TABLE_STORE_FILE) -> "TableStore":
+        with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+            tables = {}
+            for table_key, table_id, title, page, headers, summary, metadata in conn.execute(
+                    "SELECT table_key, table_id, title, page, headers, summary, metadata FROM tables ORDER BY table_key"):
+                tables[table_key] = {
+                    "table_key": table_key, "table_id": table_id, "title": title, "page": page,
+                    "headers": json.loads(headers), "summary": summary, "metadata": json.loads(metadata), "rows": []
+                }
+            for table_key, row_index, col_index, raw in conn.execute(
+                    "SELECT table_key, row_index, col_index, raw FROM cells ORDER BY table_key, row_index, col_index"):
+                rows = tables[table_key]["rows"]
+                while len(rows) <= row_index:
+                    rows.append([])
+                rows[row_index].append(raw)
+        return cls(list(tables.values()))
+
+    @staticmethod
+    def exists(path: str = TABLE_STORE_FILE) -> bool:
+        return os.path.exists(path)
+
+    def lookup(self, query: str, filters: Dict[str, any] = None, max_rows: int = TABLE_LOOKUP_MAX_ROWS,
+               max_tables: int = TABLE_LOOKUP_MAX_TABLES) -> List[Dict[str, any]]:
+        """Rows of the tables a question names, as compact chunks; empty when nothing matches precisely."""
+        query_tokens = set(tokenize(query))
+        table_ids = [table_id.rstrip(".") for table_id in TABLE_ID_PATTERN.findall(query)]
+
+        if table_ids:
+            candidates = [table for table_id in dict.fromkeys(table_ids) for table in self.by_id.get(table_id, [])]
+        else:
+            candidates = self.tables
+        candidates = [table for table in candidates if matches_filters(table["metadata"], filters)]
+
+        chunks = []
+        seen_texts = set()
+        for table in candidates:
+            matched_rows = []
+            for row, label_tokens in zip(table["rows"], table["label_tokens"]):
+                if not label_tokens:
+                    continue
+                overlap = len(label_tokens & query_tokens) / len(label_tokens)
+                if table_ids:
+                    matched = overlap >= TABLE_ROW_MATCH_THRESHOLD
+                else:
+                    # Without a table id only a full match on a multi-word label is trusted
+                    matched = overlap == 1.0 and len(label_tokens) >= 2
+                if matched:
+                    matched_rows.append(row)
+
+            if not matched_rows:
+                if not table_ids:
+                    continue
+                # The question names the table but no row, send the table itself
+                matched_rows = table["rows"]
+
+            # Keep the label column plus the columns the question names (e.g. a year), or all of them
+            columns = [i for i, tokens in enumerate(table["header_tokens"]) if i and tokens and tokens <= query_tokens]
+            columns = [0] + columns if columns else list(range(len(table["headers"])))
+            headers = [table["headers"][i] for i in columns]
+            rows = [[row[i] if i < len(row) else "" for i in columns] for row in matched_rows[:max_rows]]
+
+            text = format_table(table["title"], headers, rows)
+            # The same table can be repeated across pages (e.g. continued tables)
+            if text in seen_texts:
+                continue
+            seen_texts.add(text)
+            chunks.append({
+                # Stable per selection, so the answer cache sees the same ids for the same rows
+                "id": f"table_{table['table_key']}_{hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]}",
+                "text": text,
+                "metadata": dict(table["metadata"], page=table["page"], source_type="table_rows", table_id=table["table_id"] or ""),
+                "score": 1.0
+            })
+            if len(chunks) >= max_tables:
+                break
+        return chunks
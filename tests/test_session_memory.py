@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import ConversationMemory, session_memory_path
+
+
+def test_ids_that_sanitise_alike_get_separate_files(tmp_path):
+    assert session_memory_path("alice/x", str(tmp_path)) != session_memory_path("alice_x", str(tmp_path))
+
+    saved = ConversationMemory(persist_path=session_memory_path("alice/x", str(tmp_path)))
+    saved.add_exchange("What is the deficit?", "5% [Page 2]")
+
+    other = ConversationMemory(persist_path=session_memory_path("alice_x", str(tmp_path)))
+    assert other.is_empty()
+
+    resumed = ConversationMemory(persist_path=session_memory_path("alice/x", str(tmp_path)))
+    assert resumed.get_history() == saved.get_history()
+
+
+def test_long_ids_with_a_shared_prefix_get_separate_files(tmp_path):
+    prefix = "s" * 200
+    assert session_memory_path(prefix + "a", str(tmp_path)) != session_memory_path(prefix + "b", str(tmp_path))
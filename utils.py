@@ -1,17 +1,62 @@
-from typing import List
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from typing import List, Iterable
+import hashlib
+import json
+import os
 import re
 from rich.console import Console
-from rich.markdown import Markdown
-from rich.panel import Panel
-from config import MEMORY_WINDOW_SIZE
+import profiling
+from config import (MEMORY_WINDOW_SIZE, MEMORY_MODE, MEMORY_TOKEN_BUDGET, MEMORY_SUMMARY_RESERVE_TOKENS, MEMORY_RECENT_TURNS,
+                    MEMORY_SUMMARY_SENTENCES, MEMORY_SUMMARY_MAX_CHARS, MEMORY_SESSION_DIR, CHARS_PER_TOKEN)
+
+
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+SUMMARY_HEADER = "Summary of earlier conversation:"
+TRUNCATION_MARKER = " [...]"
+
+
+def compact_exchange(user_question: str, assistant_response: str, max_sentences: int = MEMORY_SUMMARY_SENTENCES) -> str:
+    """One summary line for a folded exchange: the question plus the lead sentences of the answer."""
+    # Drop markdown emphasis, headers and bullets but keep [Page N] citations
+    answer = re.sub(r'[*#>`_]+|^\s*[-•]\s*', '', assistant_response, flags=re.MULTILINE)
+    answer = " ".join(answer.split())
+    lead = " ".join(SENTENCE_PATTERN.split(answer)[:max_sentences])
+    if len(lead) > MEMORY_SUMMARY_MAX_CHARS:
+        lead = lead[:MEMORY_SUMMARY_MAX_CHARS].rsplit(" ", 1)[0] + "..."
+    return f"- Q: {' '.join(user_question.split())} A: {lead}"
+
+
+def session_memory_path(session_id: str, directory: str = MEMORY_SESSION_DIR) -> str:
+    # Session ids come from clients: the digest keeps distinct ids apart, the sanitised prefix is only for reading
+    prefix = re.sub(r'[^A-Za-z0-9_.-]', '_', session_id)[:40]
+    digest = hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+    return os.path.join(directory, f"{prefix}-{digest}.json")
 
 
 class ConversationMemory:
+    """Conversation history for prompts.
+
+    "window" mode keeps the last window_size exchanges verbatim. "summary" mode keeps the
+    last recent_turns verbatim and folds older ones into compact summary lines, within token_budget.
+    The verbatim turns never take the last summary_reserve tokens; a latest answer too long for the
+    rest is truncated.
+    """
     
-    def __init__(self, window_size: int = MEMORY_WINDOW_SIZE):
+    def __init__(self, window_size: int = MEMORY_WINDOW_SIZE, mode: str = MEMORY_MODE, token_budget: int = MEMORY_TOKEN_BUDGET,
+                 recent_turns: int = MEMORY_RECENT_TURNS, persist_path: str = None, summary_reserve: int = MEMORY_SUMMARY_RESERVE_TOKENS):
+        if mode not in ("window", "summary"):
+            raise ValueError(f"Unknown memory mode: {mode}")
         self.window_size = window_size
+        self.mode = mode
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.summary_reserve = min(summary_reserve, token_budget // 2)
+        self.persist_path = persist_path
         self.conversation_history = []  # List of {'user': question, 'assistant': answer}
+        self.summary = []  # Compact lines for exchanges folded out of the verbatim history
+        self._formatted = None  # Cached prompt text, rebuilt only after the history changes
+        
+        if persist_path:
+            self.load()
     
     def add_exchange(self, user_question: str, assistant_response: str):
         """Add a user-assistant exchange to memory."""
@@ -20,35 +65,128 @@ class ConversationMemory:
             'assistant': assistant_response
         })
         
-        # Maintain sliding window
-        if len(self.conversation_history) > self.window_size:
-            self.conversation_history.pop(0)  # Remove oldest
+        if self.mode == "window":
+            # Maintain sliding window
+            if len(self.conversation_history) > self.window_size:
+                self.conversation_history.pop(0)  # Remove oldest
+        else:
+            self._fold()
+        
+        self._formatted = None
+        if self.persist_path:
+            self.save()
+    
+    def _verbatim_tokens(self) -> int:
+        # Counted as formatted in the prompt, labels and separators included
+        return sum(estimate_tokens(f"User: {e['user']}\n\nAssistant: {e['assistant']}\n\n") for e in self.conversation_history)
+    
+    def _fold(self):
+        verbatim_budget = self.token_budget - self.summary_reserve
+        
+        # Fold the oldest turns into the summary until the recent turns fit, always keeping the latest verbatim
+        while len(self.conversation_history) > 1 and (
+                len(self.conversation_history) > self.recent_turns or self._verbatim_tokens() > verbatim_budget):
+            oldest = self.conversation_history.pop(0)
+            self.summary.append(compact_exchange(oldest['user'], oldest['assistant']))
+        
+        # A single long exchange is cut down rather than allowed to crowd out the summary
+        if self._verbatim_tokens() > verbatim_budget:
+            latest = self.conversation_history[-1]
+            overhead = self._verbatim_tokens() - estimate_tokens(latest['user']) - estimate_tokens(latest['assistant'])
+            question = truncate_to_tokens(latest['user'], (verbatim_budget - overhead) // 2)
+            answer = truncate_to_tokens(latest['assistant'], verbatim_budget - overhead - estimate_tokens(question))
+            self.conversation_history[-1] = {'user': question, 'assistant': answer}
+        
+        # The summary gets whatever budget the verbatim turns leave, oldest lines go first
+        summary_budget = max(0, self.token_budget - self._verbatim_tokens() - estimate_tokens(SUMMARY_HEADER + "\n"))
+        summary_tokens = sum(estimate_tokens(line + "\n") for line in self.summary)
+        while self.summary and summary_tokens > summary_budget:
+            summary_tokens -= estimate_tokens(self.summary.pop(0) + "\n")
     
     def get_history(self) -> List[dict]:
         return self.conversation_history.copy()
     
     def clear_history(self):
         self.conversation_history.clear()
+        self.summary.clear()
+        self._formatted = None
+        if self.persist_path and os.path.exists(self.persist_path):
+            os.remove(self.persist_path)
     
     def get_formatted_history(self) -> str:
-        if not self.conversation_history:
-            return ""
+        if self._formatted is not None:
+            return self._formatted
         
         formatted = []
+        if self.summary:
+            formatted.append(SUMMARY_HEADER + "\n" + "\n".join(self.summary))
         for exchange in self.conversation_history:
             formatted.append(f"User: {exchange['user']}")
             formatted.append(f"Assistant: {exchange['assistant']}")
         
-        return "\n\n".join(formatted)
+        self._formatted = "\n\n".join(formatted)
+        return self._formatted
+    
+    def token_count(self) -> int:
+        return estimate_tokens(self.get_formatted_history())
     
     def is_empty(self) -> bool:
-        return len(self.conversation_history) == 0
+        return len(self.conversation_history) == 0 and not self.summary
+    
+    def save(self):
+        directory = os.path.dirname(self.persist_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        
+        # Write to a temp file and rename so a crash never leaves a partial session
+        tmp_path = self.persist_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"mode": self.mode, "history": self.conversation_history, "summary": self.summary}, f)
+        os.replace(tmp_path, self.persist_path)
+    
+    def load(self) -> bool:
+        if not os.path.exists(self.persist_path):
+            return False
+        try:
+            with open(self.persist_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        
+        self.conversation_history = state.get("history", [])
+        self.summary = state.get("summary", [])
+        # Re-apply this memory's limits in case the session was saved with different settings
+        if self.mode == "window":
+            self.conversation_history = self.conversation_history[-self.window_size:]
+        else:
+            self._fold()
+        self._formatted = None
+        return True
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly 4 characters per token for English text, close enough for budgeting
+    return max(1, -(-len(text) // CHARS_PER_TOKEN)) if text else 0
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to about max_tokens at a word boundary, marking the cut."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max(0, max_tokens * CHARS_PER_TOKEN - len(TRUNCATION_MARKER))
+    head = text[:max_chars]
+    if " " in head:
+        head = head.rsplit(" ", 1)[0]
+    return head.rstrip() + TRUNCATION_MARKER
 
 
 def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
     if not text:
         return []
     
+    # Imported here so the chat CLI does not pay for langchain unless it indexes
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    
     # Create RecursiveCharacterTextSplitter instance
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
@@ -95,12 +233,10 @@ def extract_pages_from_response(response: str) -> List[int]:
     return sorted(list(set(int(page) for page in matches)))
 
 
-def render_markdown_response(response: str) -> None:
-    console = Console()
+def render_source_panel(response: str, console: Console = None) -> None:
+    from rich.panel import Panel
     
-    # Render the markdown
-    md = Markdown(response, hyperlinks=True)
-    console.print(md)
+    console = console or Console()
     
     # Extract and show page references at the bottom
     mentioned_pages = extract_pages_from_response(response)
@@ -121,6 +257,45 @@ def render_markdown_response(response: str) -> None:
         console.print(source_panel)
 
 
+def render_markdown_response(response: str) -> None:
+    from rich.markdown import Markdown
+    
+    console = Console()
+    
+    # Render the markdown
+    md = Markdown(response, hyperlinks=True)
+    console.print(md)
+    
+    render_source_panel(response, console)
+
+
+def render_streaming_response(events: Iterable[dict], console: Console = None) -> dict:
+    """Render streamed answer events as live-updating markdown and return the final "done" event."""
+    from rich.live import Live
+    from rich.markdown import Markdown
+    
+    console = console or Console()
+    
+    text_so_far = ""
+    result = {}
+    with Live(Markdown(""), console=console, refresh_per_second=12, vertical_overflow="visible") as live:
+        for event in events:
+            if event["type"] == "delta":
+                text_so_far += event["text"]
+                with profiling.span("render"):
+                    live.update(Markdown(text_so_far, hyperlinks=True))
+            elif event["type"] == "done":
+                result = event
+                with profiling.span("render"):
+                    live.update(Markdown(result["answer"], hyperlinks=True))
+    
+    # Source pages are only known once the full answer is in
+    with profiling.span("render"):
+        render_source_panel(result.get("answer", text_so_far), console)
+    
+    return result
+
+
 def print_thinking_animation():
     console = Console()
     return console.status("[bold green]Searching document and generating response...", spinner="dots")
\ No newline at end of file
@@ -0,0 +1,476 @@
+from typing import List, Dict, Optional, Tuple
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+from config import *
+
+
+def format_query_results(results: Dict[str, any]) -> List[Dict[str, any]]:
+    # Format results
+    retrieved_chunks = []
+    
+    if results and results['documents']:
+        documents = results['documents'][0]
+        metadatas_list = results['metadatas'][0] if results['metadatas'] else []
+        distances_list = results['distances'][0] if results['distances'] else []
+        ids_list = results['ids'][0] if results['ids'] else []
+        # Embeddings may come back as a NumPy array, so avoid truthiness checks
+        embeddings = results.get('embeddings')
+        embeddings_list = list(embeddings[0]) if embeddings is not None and len(embeddings) else []
+        
+        # Ensure all lists have same length as documents
+        while len(metadatas_list) < len(documents):
+            metadatas_list.append({})
+        while len(distances_list) < len(documents):
+            distances_list.append(0)
+        while len(ids_list) < len(documents):
+            ids_list.append('')
+        
+        for i in range(len(documents)):
+            chunk = {
+                "id": ids_list[i],
+                "text": documents[i],
+                "metadata": metadatas_list[i],
+                "score": 1 - distances_list[i]  # Convert distance to similarity score
+            }
+            if i < len(embeddings_list):
+                chunk["embedding"] = embeddings_list[i]
+            retrieved_chunks.append(chunk)
+    
+    return retrieved_chunks
+
+
+def matches_filters(metadata: Dict[str, any], filters: Optional[Dict[str, any]]) -> bool:
+    # Filters map a metadata key to a value, or to a list of accepted values
+    if not filters:
+        return True
+    for key, expected in filters.items():
+        value = metadata.get(key)
+        if isinstance(expected, (list, tuple, set)):
+            if value not in expected:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+def to_chroma_where(filters: Optional[Dict[str, any]]) -> Optional[Dict[str, any]]:
+    if not filters:
+        return None
+    clauses = []
+    for key, expected in filters.items():
+        if isinstance(expected, (list, tuple, set)):
+            clauses.append({key: {"$in": list(expected)}})
+        else:
+            clauses.append({key: expected})
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class VectorStore:
+    """Interface shared by the Chroma and NumPy backends."""
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def get_hashes(self) -> Dict[str, str]:
+        # Map of chunk id -> content hash for everything currently stored
+        raise NotImplementedError
+
+    def upsert(self, ids: List[str], embeddings: List[List[float]], documents: List[str], metadatas: List[Dict[str, any]]):
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]):
+        raise NotImplementedError
+
+    def query(self, query_embedding: List[float], n_results: int = DEFAULT_TOP_K, filters: Dict[str, any] = None) -> List[Dict[str, any]]:
+        # Returns chunks as {"id", "text", "metadata", "score", "embedding"}, best first
+        raise NotImplementedError
+
+    def get_embeddings(self, ids: List[str]) -> Dict[str, List[float]]:
+        raise NotImplementedError
+
+    def get_documents(self, ids: List[str]) -> Dict[str, Tuple[str, Dict[str, any]]]:
+        # Map of chunk id -> (text, metadata)
+        raise NotImplementedError
+
+    def get_embedding_model(self) -> Optional[str]:
+        # "<provider>:<model>" the stored vectors came from, None if it was never recorded
+        raise NotImplementedError
+
+    def set_embedding_model(self, model: str):
+        raise NotImplementedError
+
+    def commit(self):
+        # Called once at the end of an indexing run, for backends that batch their writes
+        pass
+
+
+class ChromaVectorStore(VectorStore):
+
+    def __init__(self, persist_directory: str = CHROMA_DB_PATH, create: bool = False, incremental: bool = True):
+        import chromadb  # Only loaded when this backend is selected
+
+        # Chroma caches clients per path string, so resolve it against the current directory
+        self.client = chromadb.PersistentClient(path=os.path.abspath(persist_directory))
+        if not create:
+            self.collection = self.client.get_collection(name=COLLECTION_NAME)
+            return
+
+        # Drop the existing collection for a clean rebuild
+        if not incremental:
+            existing_collections = [col.name for col in self.client.list_collections()]
+            if COLLECTION_NAME in existing_collections:
+                self.client.delete_collection(name=COLLECTION_NAME)
+
+        self.collection = self.client.get_or_create_collection(
+            name=COLLECTION_NAME,
+            metadata={"hnsw:space": "cosine"}
+        )
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def get_embedding_model(self) -> Optional[str]:
+        return (self.collection.metadata or {}).get("embedding_model")
+
+    def set_embedding_model(self, model: str):
+        if self.get_embedding_model() == model:
+            return
+        # The distance function is fixed at creation, Chroma refuses it in a modify call
+        metadata = {key: value for key, value in (self.collection.metadata or {}).items() if not key.startswith("hnsw:")}
+        self.collection.modify(metadata=dict(metadata, embedding_model=model))
+
+    def get_hashes(self) -> Dict[str, str]:
+        stored = self.collection.get(include=["metadatas"])
+        hashes = {}
+        for chunk_id, metadata in zip(stored['ids'], stored['metadatas'] or []):
+            hashes[chunk_id] = (metadata or {}).get("content_hash", "")
+        return hashes
+
+    def upsert(self, ids: List[str], embeddings: List[List[float]], documents: List[str], metadatas: List[Dict[str, any]]):
+        for start in range(0, len(ids), INDEX_WRITE_BATCH_SIZE):
+            end = start + INDEX_WRITE_BATCH_SIZE
+            self.collection.upsert(
+                documents=documents[start:end],
+                embeddings=embeddings[start:end],
+                metadatas=metadatas[start:end],
+                ids=ids[start:end]
+            )
+
+    def delete(self, ids: List[str]):
+        for start in range(0, len(ids), INDEX_WRITE_BATCH_SIZE):
+            self.collection.delete(ids=ids[start:start + INDEX_WRITE_BATCH_SIZE])
+
+    def query(self, query_embedding: List[float], n_results: int = DEFAULT_TOP_K, filters: Dict[str, any] = None) -> List[Dict[str, any]]:
+        results = self.collection.query(
+            query_embeddings=[query_embedding],
+            n_results=n_results,
+            where=to_chroma_where(filters),
+            include=["documents", "metadatas", "distances", "embeddings"]
+        )
+        return format_query_results(results)
+
+    def get_embeddings(self, ids: List[str]) -> Dict[str, List[float]]:
+        stored = self.collection.get(ids=ids, include=["embeddings"])
+        embeddings = stored.get('embeddings')
+        return dict(zip(stored['ids'], embeddings if embeddings is not None else []))
+
+    def get_documents(self, ids: List[str]) -> Dict[str, Tuple[str, Dict[str, any]]]:
+        documents = {}
+        for start in range(0, len(ids), INDEX_WRITE_BATCH_SIZE):
+            stored = self.collection.get(ids=ids[start:start + INDEX_WRITE_BATCH_SIZE], include=["documents", "metadatas"])
+            for chunk_id, document, metadata in zip(stored['ids'], stored['documents'], stored['metadatas']):
+                documents[chunk_id] = (document, metadata or {})
+        return documents
+
+
+class NumpyVectorStore(VectorStore):
+    """Exact search over a memory-mapped .npy matrix of normalized embeddings.
+
+    Texts and metadata live in a SQLite sidecar. Upserts are appended to a staging file and
+    commit() streams them into a new matrix once per indexing run, instead of rewriting it per batch.
+    """
+
+    def __init__(self, directory: str = NUMPY_STORE_DIR, dtype: str = NUMPY_STORE_DTYPE):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.db_path = os.path.join(directory, "records.sqlite3")
+        self.staging_path = os.path.join(directory, "staging.f32")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Indexing upserts from its flush thread, queries come from the server's worker threads
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS chunks (
+                id TEXT PRIMARY KEY,
+                position INTEGER,
+                staged_row INTEGER,
+                document TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                content_hash TEXT NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        self._migrate_json()
+        self._load()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: Optional[str]):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _migrate_json(self):
+        # Stores written before the SQLite sidecar kept everything in metadata.json next to embeddings.npy
+        json_path = os.path.join(self.directory, "metadata.json")
+        if not os.path.exists(json_path):
+            return
+        with open(json_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with self._lock:
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.executemany(
+                "INSERT INTO chunks (id, position, staged_row, document, metadata, content_hash) VALUES (?, ?, NULL, ?, ?, ?)",
+                [(chunk_id, position, document, json.dumps(metadata), metadata.get("content_hash", ""))
+                 for position, (chunk_id, document, metadata) in enumerate(zip(meta["ids"], meta["documents"], meta["metadatas"]))]
+            )
+            self._set_meta("matrix", "embeddings.npy")
+            self._set_meta("embedding_model", meta.get("embedding_model"))
+            self._conn.commit()
+        os.remove(json_path)
+
+    def _load(self):
+        # Only ids and metadata of the committed rows are kept in memory, texts are read per query
+        with self._lock:
+            matrix_name = self._get_meta("matrix")
+            self.embedding_model = self._get_meta("embedding_model")
+            rows = self._conn.execute("SELECT id, metadata FROM chunks WHERE position IS NOT NULL ORDER BY position").fetchall()
+        matrix_path = os.path.join(self.directory, matrix_name) if matrix_name else None
+        if matrix_path and os.path.exists(matrix_path) and rows:
+            # mmap keeps startup near zero, pages are read on first use
+            self.matrix = np.load(matrix_path, mmap_mode="r")
+        else:
+            self.matrix = np.zeros((0, 0), dtype=self.dtype)
+            rows = []
+        self.ids = [chunk_id for chunk_id, _ in rows]
+        self.metadatas = [json.loads(metadata) for _, metadata in rows]
+        self.positions = {chunk_id: i for i, chunk_id in enumerate(self.ids)}
+        # Rows grouped per document act as shards for doc_id filters
+        doc_rows = {}
+        for i, metadata in enumerate(self.metadatas):
+            doc_rows.setdefault(metadata.get("doc_id"), []).append(i)
+        self.doc_rows = {doc_id: np.array(rows, dtype=np.int64) for doc_id, rows in doc_rows.items()}
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def get_embedding_model(self) -> Optional[str]:
+        return self.embedding_model
+
+    def set_embedding_model(self, model: str):
+        with self._lock:
+            if self.embedding_model == model:
+                return
+            self.embedding_model = model
+            # Only the sidecar changes, the matrix stays as it is
+            self._set_meta("embedding_model", model)
+            self._conn.commit()
+
+    def get_hashes(self) -> Dict[str, str]:
+        # Staged chunks count as stored, a resumed run does not embed them again
+        with self._lock:
+            return dict(self._conn.execute("SELECT id, content_hash FROM chunks").fetchall())
+
+    def upsert(self, ids: List[str], embeddings: List[List[float]], documents: List[str], metadatas: List[Dict[str, any]]):
+        if not ids:
+            return
+
+        new_rows = np.array(embeddings, dtype=np.float32)
+        new_rows /= np.maximum(np.linalg.norm(new_rows, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            dimension = self._get_meta("dimension")
+            if dimension is not None and int(dimension) != new_rows.shape[1]:
+                raise ValueError(f"Embeddings have {new_rows.shape[1]} dimensions but the store holds {dimension}, re-run indexing with --rebuild")
+
+            # Rows are only appended; a partial row left by a crash is cut off first
+            first_row = os.path.getsize(self.staging_path) // (4 * new_rows.shape[1]) if os.path.exists(self.staging_path) else 0
+            with open(self.staging_path, "ab") as f:
+                f.truncate(first_row * 4 * new_rows.shape[1])
+                f.write(new_rows.tobytes())
+
+            # An updated chunk keeps its committed position until commit() swaps the new row in
+            self._conn.executemany(
+                "INSERT INTO chunks (id, position, staged_row, document, metadata, content_hash) VALUES (?, NULL, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET staged_row = excluded.staged_row, document = excluded.document, "
+                "metadata = excluded.metadata, content_hash = excluded.content_hash",
+                [(chunk_id, first_row + i, document, json.dumps(metadata), metadata.get("content_hash", ""))
+                 for i, (chunk_id, document, metadata) in enumerate(zip(ids, documents, metadatas))]
+            )
+            self._set_meta("dimension", str(new_rows.shape[1]))
+            self._set_meta("dirty", "1")
+            self._conn.commit()
+
+    def delete(self, ids: List[str]):
+        if not ids:
+            return
+
+        with self._lock:
+            for start in range(0, len(ids), INDEX_WRITE_BATCH_SIZE):
+                batch = ids[start:start + INDEX_WRITE_BATCH_SIZE]
+                self._conn.execute(f"DELETE FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch)
+            if not self._conn.execute("SELECT 1 FROM chunks WHERE staged_row IS NOT NULL LIMIT 1").fetchone():
+                # Nothing staged is left, so a rebuild may switch to another embedding dimension
+                if os.path.exists(self.staging_path):
+                    os.remove(self.staging_path)
+                if not self._conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone():
+                    self._set_meta("dimension", None)
+            self._set_meta("dirty", "1")
+            self._conn.commit()
+
+    def commit(self):
+        """Stream committed and staged rows into a new matrix file and swap it in."""
+        with self._lock:
+            if self._get_meta("dirty") != "1":
+                return
+            rows = self._conn.execute(
+                "SELECT id, position, staged_row FROM chunks ORDER BY position IS NULL, position, staged_row"
+            ).fetchall()
+            generation = int(self._get_meta("generation") or 0) + 1
+            old_name = self._get_meta("matrix")
+            new_name = f"embeddings.{generation}.npy" if rows else None
+
+            if rows:
+                dimension = int(self._get_meta("dimension"))
+                staged = None
+                if os.path.exists(self.staging_path):
+                    staged_rows = os.path.getsize(self.staging_path) // (4 * dimension)
+                    staged = np.memmap(self.staging_path, dtype=np.float32, mode="r", shape=(staged_rows, dimension))
+                positions = np.array([-1 if position is None else position for _, position, _ in rows], dtype=np.int64)
+                staged_rows = np.array([-1 if staged_row is None else staged_row for _, _, staged_row in rows], dtype=np.int64)
+                matrix = np.lib.format.open_memmap(os.path.join(self.directory, new_name), mode="w+", dtype=self.dtype, shape=(len(rows), dimension))
+                # Copied in blocks, neither the old matrix nor the staged rows are read into memory at once
+                for start in range(0, len(rows), INDEX_WRITE_BATCH_SIZE):
+                    end = min(start + INDEX_WRITE_BATCH_SIZE, len(rows))
+                    block = np.empty((end - start, dimension), dtype=np.float32)
+                    is_staged = staged_rows[start:end] >= 0
+                    if is_staged.any():
+                        block[is_staged] = staged[staged_rows[start:end][is_staged]]
+                    if not is_staged.all():
+                        block[~is_staged] = self.matrix[positions[start:end][~is_staged]]
+                    matrix[start:end] = block
+                matrix.flush()
+                del matrix, staged
+
+            # Positions and the matrix name change in one transaction, readers see the old or the new matrix
+            self._conn.executemany("UPDATE chunks SET position = ?, staged_row = NULL WHERE id = ?",
+                                   [(i, chunk_id) for i, (chunk_id, _, _) in enumerate(rows)])
+            self._set_meta("matrix", new_name)
+            self._set_meta("generation", str(generation))
+            self._set_meta("dirty", "0")
+            self._conn.commit()
+
+        if os.path.exists(self.staging_path):
+            os.remove(self.staging_path)
+        self.matrix = None
+        if old_name and old_name != new_name and os.path.exists(os.path.join(self.directory, old_name)):
+            os.remove(os.path.join(self.directory, old_name))
+        self._load()
+
+    def candidate_rows(self, filters: Optional[Dict[str, any]]) -> Optional[np.ndarray]:
+        # None means every row; otherwise only rows matching the filters
+        if not filters:
+            return None
+
+        rows = None
+        if "doc_id" in filters:
+            doc_ids = filters["doc_id"]
+            if not isinstance(doc_ids, (list, tuple, set)):
+                doc_ids = [doc_ids]
+            shards = [self.doc_rows[d] for d in doc_ids if d in self.doc_rows]
+            rows = np.concatenate(shards) if shards else np.zeros(0, dtype=np.int64)
+
+        other_filters = {key: value for key, value in filters.items() if key != "doc_id"}
+        if other_filters:
+            scan = rows if rows is not None else range(len(self.ids))
+            rows = np.array([i for i in scan if matches_filters(self.metadatas[i], other_filters)], dtype=np.int64)
+        return rows
+
+    def _texts(self, ids: List[str]) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._conn.execute(f"SELECT id, document FROM chunks WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall())
+
+    def query(self, query_embedding: List[float], n_results: int = DEFAULT_TOP_K, filters: Dict[str, any] = None) -> List[Dict[str, any]]:
+        matrix = self.matrix
+        if not len(self.ids):
+            return []
+
+        query = np.array(query_embedding, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        query = query.astype(matrix.dtype)
+
+        # Rows are stored normalized, so one matrix-vector product gives cosine similarity
+        rows = self.candidate_rows(filters)
+        if rows is None:
+            scores = matrix @ query
+            row_ids = None
+        else:
+            if not len(rows):
+                return []
+            scores = matrix[rows] @ query
+            row_ids = rows
+
+        n_results = min(n_results, len(scores))
+        top = np.argpartition(-scores, n_results - 1)[:n_results]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        result_scores = scores[top]
+        if row_ids is not None:
+            top = row_ids[top]
+
+        texts = self._texts([self.ids[i] for i in top])
+        return [
+            {
+                "id": self.ids[i],
+                "text": texts.get(self.ids[i], ""),
+                "metadata": self.metadatas[i],
+                "score": float(score),
+                "embedding": matrix[i].astype(np.float32)
+            }
+            for i, score in zip(top, result_scores)
+        ]
+
+    def get_embeddings(self, ids: List[str]) -> Dict[str, List[float]]:
+        return {
+            chunk_id: self.matrix[self.positions[chunk_id]].astype(np.float32)
+            for chunk_id in ids if chunk_id in self.positions
+        }
+
+    def get_documents(self, ids: List[str]) -> Dict[str, Tuple[str, Dict[str, any]]]:
+        documents = {}
+        with self._lock:
+            for start in range(0, len(ids), INDEX_WRITE_BATCH_SIZE):
+                batch = ids[start:start + INDEX_WRITE_BATCH_SIZE]
+                rows = self._conn.execute(f"SELECT id, document, metadata FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch)
+                for chunk_id, document, metadata in rows:
+                    documents[chunk_id] = (document, json.loads(metadata))
+        return documents
+
+
+def open_vector_store(backend: str = VECTOR_STORE_BACKEND, create: bool = False, incremental: bool = True, persist_directory: str = CHROMA_DB_PATH) -> VectorStore:
+    if backend == "chroma":
+        return ChromaVectorStore(persist_directory, create=create, incremental=incremental)
+    if backend == "numpy":
+        # NUMPY_STORE_DIR sits inside the default persist directory, other directories get their own store
+        directory = NUMPY_STORE_DIR if persist_directory == CHROMA_DB_PATH else os.path.join(persist_directory, os.path.basename(NUMPY_STORE_DIR))
+        store = NumpyVectorStore(directory)
+        if create and not incremental:
+            store.delete(list(store.get_hashes()))
+        elif not create and not store.count():
+            raise ValueError(f"No vectors found in {store.directory}, run indexing first")
+        return store
+    raise ValueError(f"Unknown vector store backend: {backend}")